@@ -6,7 +6,30 @@ import aiohttp
 from bs4 import BeautifulSoup
 import asyncpg
 import os
+import io
+import csv
+import sys
+import json
+import decimal
+import hashlib
+import cProfile
+import pstats
+import socket
+import time
+import asyncio
+import threading
+import traceback
+import bisect
+import heapq
 import functools
+import itertools
+import contextlib
+import collections
+import unicodedata
+import contextvars
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 
 load_dotenv('linkdata.env')
@@ -18,20 +41,62 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-intents.voice_states = True
+# Set LEAN_MEMORY=true to cache only members who are in voice channels and skip member chunking at
+# startup. Everything else the bot needs arrives with interactions and voice events, and members
+# outside voice are fetched from the API on demand.
+LEAN_MEMORY = os.getenv("LEAN_MEMORY", "false").lower() in ("1", "true", "yes")
 
-class MyClient(discord.Client):
+if LEAN_MEMORY:
+    # Messages are only ever sent and deleted, never read, so no message or reaction events
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.members = True
+    intents.voice_states = True
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+else:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.members = True
+    intents.voice_states = True
+    member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+
+# Set USE_AUTOSHARD=true once the bot serves enough guilds to need more than one gateway shard
+USE_AUTOSHARD = os.getenv("USE_AUTOSHARD", "false").lower() in ("1", "true", "yes")
+ClientBase = discord.AutoShardedClient if USE_AUTOSHARD else discord.Client
+
+class MyClient(ClientBase):
     def __init__(self):
-        super().__init__(intents=intents)
+        super().__init__(
+            intents=intents,
+            member_cache_flags=member_cache_flags,
+            chunk_guilds_at_startup=not LEAN_MEMORY
+        )
         self.tree = app_commands.CommandTree(self)
 
+    async def setup_hook(self):
+        # Runs before the gateway connects, so the first voice joins after a deploy are served warm
+        await load_warm_snapshot()
+
+    async def close(self):
+        # The final writes mustn't wait for background jobs' slots while the bot shuts down
+        async with work_priority('background', job_limit=False):
+            # Buffered voice sessions would be lost once the pool goes away
+            await shutdown_voice_sessions()
+            if write_warm_snapshot.is_running():
+                write_warm_snapshot.cancel()
+                await write_warm_snapshot()
+        await super().close()
+
 bot = MyClient()
 player_data = {}
 db_pool = None
-user_messages = {}  # Store message IDs by user ID for deletion when they leave
+user_messages = {}  # Store message IDs by (guild ID, user ID) for deletion when they leave
+guild_configs = {}  # Per-guild configuration loaded from the guild_config tables, keyed by guild ID
+
+# Home guild defaults, seeded into guild_config the first time the bot starts.
+# Every other guild is configured through the guild_config / guild_squadrons tables.
+HOME_GUILD_ID = 779462911713607690
 
 # Define monitored voice channels
 MONITORED_VOICE_CHANNELS = [--, --]
@@ -50,45 +115,570 @@ role_squadron_mapping = {
     'BFXRY Member': 'Blackfoot X-Ray'
 }
 
-@bot.event
-async def on_ready():
+# ──────────────── SQL STATEMENTS ────────────────
+
+# Every statement on a hot path lives here so scripts/query_plan_check.py can EXPLAIN it
+# against production-sized data. Add new hot queries as *_SQL constants and give them a
+# plan budget in that script; it fails on any constant it has no budget for.
+# BR filters compare vehicle_br as NUMERIC (pass br_param(br)) so the index on it is usable.
+
+CURRENT_BR_SQL = """
+    SELECT sqb_br, EXTRACT(EPOCH FROM (end_date - NOW())) AS seconds_left
+    FROM sqb_schedule
+    WHERE NOW() BETWEEN sqb_date AND end_date
+    LIMIT 1
+"""
+
+NEXT_SQB_START_SQL = """
+    SELECT EXTRACT(EPOCH FROM (MIN(sqb_date) - NOW()))
+    FROM sqb_schedule
+    WHERE sqb_date > NOW()
+"""
+
+CATALOG_FOR_BR_SQL = """
+    SELECT vt.vehicle_id, vt.vehicle_name, vt.vehicle_type, n.nation_name, n.nation_id
+    FROM vehicle_table vt
+    JOIN nations n ON vt.nation_id = n.nation_id
+    WHERE vt.vehicle_br = $1::numeric AND NOT vt.retired
+    ORDER BY 
+        CASE WHEN n.nation_id = 11 THEN 1 ELSE 0 END,
+        n.nation_id,
+        vt.vehicle_name
+"""
+
+# Full catalog for the in-memory vehicle search index, a sequential scan by design
+VEHICLE_CATALOG_ALL_SQL = """
+    SELECT vt.vehicle_id, vt.vehicle_name, vt.vehicle_type, vt.vehicle_br, n.nation_name, n.nation_id
+    FROM vehicle_table vt
+    JOIN nations n ON vt.nation_id = n.nation_id
+    WHERE NOT vt.retired
+"""
+
+USER_LOADOUT_SQL = """
+    SELECT vt.vehicle_id, vt.vehicle_name, vt.vehicle_type, n.nation_name, n.nation_id
+    FROM discord_data_gathered dg
+    JOIN vehicle_table vt ON vt.vehicle_id = dg.vehicle_id
+    JOIN nations n ON vt.nation_id = n.nation_id
+    WHERE dg.discord_id = $1 AND vt.vehicle_br = $2::numeric AND NOT vt.retired
+    ORDER BY 
+        CASE WHEN n.nation_id = 11 THEN 1 ELSE 0 END,
+        n.nation_id,
+        vt.vehicle_type,
+        vt.vehicle_name
+"""
+
+USER_VEHICLE_EXISTS_SQL = """
+    SELECT 1 FROM discord_data_gathered
+    WHERE discord_id = $1 AND vehicle_id = $2
+"""
+
+INSERT_USER_VEHICLE_SQL = """
+    INSERT INTO discord_data_gathered (discord_id, vehicle_id, warthunder_user)
+    VALUES ($1, $2, $3)
+"""
+
+# Which of the given vehicles a user already has, for diffing a menu selection
+USER_VEHICLE_IDS_SQL = """
+    SELECT vehicle_id FROM discord_data_gathered
+    WHERE discord_id = $1 AND vehicle_id = ANY($2::int[])
+"""
+
+# No unique constraint backs (discord_id, vehicle_id): adopted legacy rows may duplicate a pair,
+# so vehicles the user already has are skipped with NOT EXISTS rather than ON CONFLICT
+INSERT_USER_VEHICLES_SQL = """
+    INSERT INTO discord_data_gathered (discord_id, vehicle_id, warthunder_user)
+    SELECT $1::bigint, v.vehicle_id, $3
+    FROM unnest($2::int[]) AS v(vehicle_id)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM discord_data_gathered dg
+        WHERE dg.discord_id = $1::bigint AND dg.vehicle_id = v.vehicle_id
+    )
+"""
+
+DELETE_USER_VEHICLES_SQL = """
+    DELETE FROM discord_data_gathered WHERE discord_id = $1 AND vehicle_id = ANY($2::int[])
+"""
+
+# Rows were originally keyed by "name#discriminator" text, which breaks on renames and collapses
+# to "#0" since Discord dropped discriminators. They're now keyed by the member's snowflake;
+# user_id is kept only so rows stored under the old key can still be adopted by their owner.
+DISCORD_ID_MIGRATION_DDL = """
+    ALTER TABLE discord_data_gathered ADD COLUMN IF NOT EXISTS discord_id BIGINT;
+    ALTER TABLE discord_data_gathered ALTER COLUMN user_id DROP NOT NULL;
+"""
+
+# Legacy keys that still have rows waiting for a discord_id (served by the partial index)
+UNADOPTED_USER_KEYS_SQL = """
+    SELECT DISTINCT user_id FROM discord_data_gathered WHERE discord_id IS NULL
+"""
+
+# Attach discord_id to legacy rows, given parallel arrays of old keys and member IDs
+ADOPT_LEGACY_ROWS_SQL = """
+    UPDATE discord_data_gathered dg
+    SET discord_id = m.discord_id
+    FROM unnest($1::text[], $2::bigint[]) AS m(user_id, discord_id)
+    WHERE dg.user_id = m.user_id AND dg.discord_id IS NULL
+"""
+
+# How many vehicles each of the given users has stored at the BR (users with none are absent)
+LOADOUT_COUNTS_SQL = """
+    SELECT dg.discord_id, COUNT(*) AS vehicles
+    FROM discord_data_gathered dg
+    JOIN vehicle_table vt ON vt.vehicle_id = dg.vehicle_id
+    WHERE dg.discord_id = ANY($2::bigint[]) AND vt.vehicle_br = $1::numeric AND NOT vt.retired
+    GROUP BY dg.discord_id
+"""
+
+# One row per vehicle at the BR owned by any of the given users, with the owners aggregated
+ROSTER_MATRIX_SQL = """
+    SELECT vt.vehicle_id, vt.vehicle_name, vt.vehicle_type, n.nation_name,
+           array_agg(dg.discord_id ORDER BY dg.discord_id) AS owners
+    FROM discord_data_gathered dg
+    JOIN vehicle_table vt ON vt.vehicle_id = dg.vehicle_id
+    JOIN nations n ON vt.nation_id = n.nation_id
+    WHERE dg.discord_id = ANY($2::bigint[]) AND vt.vehicle_br = $1::numeric AND NOT vt.retired
+    GROUP BY vt.vehicle_id, vt.vehicle_name, vt.vehicle_type, n.nation_name, n.nation_id
+    ORDER BY 
+        CASE WHEN n.nation_id = 11 THEN 1 ELSE 0 END,
+        n.nation_id,
+        vt.vehicle_type,
+        vt.vehicle_name
+"""
+
+# Full load to build the in-memory player name index, a sequential scan by design
+SQUADRON_CACHE_ALL_SQL = """
+    SELECT player_name, squadron_name, points, activity
+    FROM squadron_cache
+"""
+
+MEMBER_PLAYER_MAP_ALL_SQL = """
+    SELECT member_id, squadron_name, player_key, match_type FROM member_player_map
+"""
+
+MEMBER_PLAYER_MAP_UPSERT_SQL = """
+    INSERT INTO member_player_map (member_id, squadron_name, player_key, match_type)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (member_id) DO UPDATE SET
+        squadron_name = EXCLUDED.squadron_name,
+        player_key = EXCLUDED.player_key,
+        match_type = EXCLUDED.match_type,
+        updated_at = NOW()
+"""
+
+SQUADRON_CACHE_DELETE_SQL = """
+    DELETE FROM squadron_cache WHERE squadron_name = ANY($1::text[])
+"""
+
+SQUADRON_CACHE_UPSERT_SQL = """
+    INSERT INTO squadron_cache (player_name, squadron_name, points, activity)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (player_name) DO UPDATE SET
+        squadron_name = EXCLUDED.squadron_name,
+        points = EXCLUDED.points,
+        activity = EXCLUDED.activity,
+        last_updated = NOW()
+"""
+
+SQUADRON_CACHE_DDL = """
+    CREATE TABLE IF NOT EXISTS squadron_cache (
+        player_name TEXT PRIMARY KEY,
+        squadron_name TEXT NOT NULL,
+        points INTEGER NOT NULL,
+        activity INTEGER NOT NULL,
+        last_updated TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    )
+"""
+
+MEMBER_PLAYER_MAP_DDL = """
+    CREATE TABLE IF NOT EXISTS member_player_map (
+        member_id BIGINT PRIMARY KEY,
+        squadron_name TEXT NOT NULL,
+        player_key TEXT NOT NULL,
+        match_type TEXT NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    )
+"""
+
+# Change detection for catalog imports: the hash of each row as last imported, and a flag for
+# vehicles an import no longer lists (kept so stored loadouts keep their foreign keys)
+VEHICLE_CATALOG_COLUMNS_DDL = """
+    ALTER TABLE vehicle_table
+        ADD COLUMN IF NOT EXISTS row_hash TEXT,
+        ADD COLUMN IF NOT EXISTS retired BOOLEAN NOT NULL DEFAULT FALSE
+"""
+
+# Per-connection staging table an import is COPYed into; emptied when the import commits
+CATALOG_STAGING_DDL = """
+    CREATE TEMP TABLE IF NOT EXISTS catalog_staging (
+        vehicle_name TEXT NOT NULL,
+        nation_id INTEGER NOT NULL,
+        vehicle_type TEXT NOT NULL,
+        vehicle_br NUMERIC(3, 1) NOT NULL,
+        row_hash TEXT NOT NULL,
+        PRIMARY KEY (nation_id, vehicle_name)
+    ) ON COMMIT DELETE ROWS
+"""
+
+NATIONS_SQL = """
+    SELECT nation_id, nation_name FROM nations
+"""
+
+# Active, non-placeholder vehicles of the imported nations that the import no longer lists
+CATALOG_RETIRE_CONDITION = """
+    NOT vt.retired
+    AND vt.vehicle_name NOT ILIKE '%no vehicle%' AND vt.vehicle_name NOT ILIKE '%n/a%'
+    AND vt.nation_id IN (SELECT nation_id FROM catalog_staging)
+    AND NOT EXISTS (
+        SELECT 1 FROM catalog_staging s
+        WHERE s.nation_id = vt.nation_id AND s.vehicle_name = vt.vehicle_name
+    )
+"""
+
+# What the import would change, per imported nation so the mass-retire guard can't be diluted
+# by the other nations in the same file
+CATALOG_IMPORT_DIFF_SQL = f"""
+    WITH listed AS (
+        SELECT s.nation_id,
+               COUNT(*) AS listed,
+               COUNT(*) FILTER (WHERE vt.vehicle_id IS NULL) AS inserted,
+               COUNT(*) FILTER (WHERE vt.vehicle_br <> s.vehicle_br) AS rerated,
+               COUNT(*) FILTER (WHERE vt.vehicle_type <> s.vehicle_type) AS retyped,
+               COUNT(*) FILTER (WHERE vt.retired) AS restored
+        FROM catalog_staging s
+        LEFT JOIN vehicle_table vt ON vt.nation_id = s.nation_id AND vt.vehicle_name = s.vehicle_name
+        GROUP BY s.nation_id
+    ), current AS (
+        SELECT vt.nation_id,
+               COUNT(*) FILTER (WHERE NOT vt.retired) AS active,
+               COUNT(*) FILTER (WHERE {CATALOG_RETIRE_CONDITION}) AS retiring
+        FROM vehicle_table vt
+        WHERE vt.nation_id IN (SELECT nation_id FROM catalog_staging)
+        GROUP BY vt.nation_id
+    )
+    SELECT l.*, COALESCE(c.active, 0) AS active, COALESCE(c.retiring, 0) AS retiring
+    FROM listed l
+    LEFT JOIN current c ON c.nation_id = l.nation_id
+    ORDER BY l.nation_id
+"""
+
+# Rows whose hash differs (or that come back from retirement); unchanged rows aren't touched
+CATALOG_IMPORT_UPDATE_SQL = """
+    UPDATE vehicle_table vt
+    SET vehicle_type = s.vehicle_type, vehicle_br = s.vehicle_br, row_hash = s.row_hash, retired = FALSE
+    FROM catalog_staging s
+    WHERE vt.nation_id = s.nation_id AND vt.vehicle_name = s.vehicle_name
+        AND (vt.row_hash IS DISTINCT FROM s.row_hash OR vt.retired)
+"""
+
+CATALOG_IMPORT_INSERT_SQL = """
+    INSERT INTO vehicle_table (vehicle_name, vehicle_type, nation_id, vehicle_br, row_hash)
+    SELECT s.vehicle_name, s.vehicle_type, s.nation_id, s.vehicle_br, s.row_hash
+    FROM catalog_staging s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM vehicle_table vt
+        WHERE vt.nation_id = s.nation_id AND vt.vehicle_name = s.vehicle_name
+    )
+"""
+
+CATALOG_IMPORT_RETIRE_SQL = f"""
+    UPDATE vehicle_table vt SET retired = TRUE
+    WHERE {CATALOG_RETIRE_CONDITION}
+"""
+
+VOICE_SESSIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS voice_sessions (
+        session_id BIGSERIAL PRIMARY KEY,
+        guild_id BIGINT NOT NULL,
+        member_id BIGINT NOT NULL,
+        channel_id BIGINT NOT NULL,
+        joined_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        left_at TIMESTAMP WITH TIME ZONE NOT NULL
+    )
+"""
+
+# Members present and member-hours for each SQB window that started since $2, counting only the
+# part of each session that overlaps the window
+VOICE_ATTENDANCE_SQL = """
+    SELECT w.sqb_date, w.sqb_br,
+           COUNT(DISTINCT vs.member_id) AS members,
+           COALESCE(SUM(EXTRACT(EPOCH FROM LEAST(vs.left_at, w.end_date) - GREATEST(vs.joined_at, w.sqb_date))), 0) / 3600 AS member_hours
+    FROM sqb_schedule w
+    LEFT JOIN voice_sessions vs ON vs.guild_id = $1
+        AND vs.joined_at >= $2::timestamptz - interval '1 day'
+        AND vs.joined_at < w.end_date AND vs.left_at > w.sqb_date
+    WHERE w.sqb_date >= $2::timestamptz AND w.sqb_date < NOW()
+    GROUP BY w.sqb_date, w.sqb_br
+    ORDER BY w.sqb_date DESC
+    LIMIT $3
+"""
+
+VOICE_HOURS_SQL = """
+    SELECT member_id, COUNT(*) AS sessions,
+           SUM(EXTRACT(EPOCH FROM left_at - joined_at)) / 3600 AS hours
+    FROM voice_sessions
+    WHERE guild_id = $1 AND joined_at >= $2
+    GROUP BY member_id
+    ORDER BY hours DESC
+    LIMIT $3
+"""
+
+# Indexes the hot queries above rely on, created at startup. The BR index covers the catalog
+# columns so a per-BR catalog load is an index-only scan however the table is ordered, and
+# only holds vehicles still in the game. The loadout index holds every column the loadout,
+# roster and audit queries read from discord_data_gathered.
+INDEX_DDL = [
+    "DROP INDEX IF EXISTS idx_vehicle_table_br",
+    "CREATE INDEX IF NOT EXISTS idx_vehicle_table_br_active ON vehicle_table (vehicle_br) INCLUDE (vehicle_id, vehicle_name, vehicle_type, nation_id) WHERE NOT retired",
+    "CREATE INDEX IF NOT EXISTS idx_vehicle_table_nation_name ON vehicle_table (nation_id, vehicle_name)",
+    "DROP INDEX IF EXISTS idx_discord_data_gathered_user_vehicle",
+    "CREATE INDEX IF NOT EXISTS idx_discord_data_gathered_member_vehicle ON discord_data_gathered (discord_id, vehicle_id)",
+    "CREATE INDEX IF NOT EXISTS idx_discord_data_gathered_unadopted ON discord_data_gathered (user_id) WHERE discord_id IS NULL",
+    "CREATE INDEX IF NOT EXISTS idx_sqb_schedule_window ON sqb_schedule (end_date, sqb_date)",
+    "CREATE INDEX IF NOT EXISTS idx_squadron_cache_squadron ON squadron_cache (squadron_name)",
+    "CREATE INDEX IF NOT EXISTS idx_voice_sessions_guild_joined ON voice_sessions (guild_id, joined_at) INCLUDE (member_id, left_at)"
+]
+
+async def ensure_indexes():
+    """Create the bot's own tables, the added columns and the indexes hot queries depend on"""
+    if db_pool is None:
+        return
+
+    try:
+        async with unit_of_work() as conn:
+            await conn.execute(VEHICLE_CATALOG_COLUMNS_DDL)
+            await conn.execute(DISCORD_ID_MIGRATION_DDL)
+            await conn.execute(SQUADRON_CACHE_DDL)
+            await conn.execute(MEMBER_PLAYER_MAP_DDL)
+            await conn.execute(VOICE_SESSIONS_DDL)
+            for ddl in INDEX_DDL:
+                await conn.execute(ddl)
+        print("✅ Database indexes verified")
+    except Exception as e:
+        print(f"❌ Failed to create database indexes: {e}")
+
+database_setup_lock = asyncio.Lock()
+
+async def setup_database():
+    """Create the pool, the schema and the in-memory indexes; returns whether the pool is up"""
     global db_pool
     try:
-        db_pool = await asyncpg.create_pool(
+        pool = await asyncpg.create_pool(
             host=DB_HOST,
             port=DB_PORT,
             user=DB_USER,
             password=DB_PASSWORD,
             database=DB_NAME,
             min_size=1,
-            max_size=10,
+            max_size=POOL_MAX_SIZE,
             command_timeout=60
         )
         print("✅ Connected to PostgreSQL.")
     except Exception as e:
         print(f"❌ Failed to connect to PostgreSQL: {e}")
         print("Please check your database connection settings in the .env file")
-        return
+        return False
+    db_pool = pool
 
-    try:
-        guild = discord.Object(id=779462911713607690)
-        await bot.tree.sync(guild=guild)
-        print("✅ Slash commands synced to guild.")
-    except Exception as e:
-        print(f"❌ Failed to sync commands: {e}")
+    await load_guild_configs()
+    await ensure_indexes()
+    await install_cache_triggers()
+    if not maintain_cache_listener.is_running():
+        maintain_cache_listener.start()
+    await load_member_player_map()
+    # Either index may already be warm from the snapshot; the listener rebuilds it if it changed
+    if not player_name_index.loaded:
+        await refresh_player_name_index()
+    if not vehicle_search_index.loaded:
+        await refresh_vehicle_search_index()
+    await load_unadopted_user_keys()
+    return True
+
+@bot.event
+async def on_ready():
+    # on_ready fires again after every gateway reconnect: the pool and the schema setup happen once,
+    # or again on the next one if the database was unreachable
+    async with database_setup_lock:
+        if db_pool is None and not await setup_database():
+            return
+
+    await sync_configured_guilds()
+
+    if not loop_watchdog.running:
+        loop_watchdog.start(asyncio.get_running_loop())
+        print(f"✅ Event loop watchdog started (warns on stalls > {LOOP_LAG_WARN_SECONDS}s)")
 
     print(f'Logged in as {bot.user.name}')
-    for command in bot.tree.get_commands(guild=discord.Object(id=--)):
+    if LEAN_MEMORY:
+        print("✅ Lean memory mode: caching voice channel members only, member chunking disabled")
+    if bot.shard_count:
+        print(f"✅ Running with {bot.shard_count} shard(s) across {len(bot.guilds)} guild(s)")
+    for command in bot.tree.get_commands(guild=discord.Object(id=HOME_GUILD_ID)):
         print(f"✅ Slash command registered in guild: /{command.name}")
     
+    # Settle leadership first so the first squadron update runs on exactly one instance
+    if not leader_election.is_running():
+        await leader_election()
+        leader_election.start()
+
     # Start the squadron data update task
-    update_squadron_data.start()
-    print("✅ Squadron data update task started (runs every 6 hours)")
-    print(f"📢 Monitoring voice channels: {MONITORED_VOICE_CHANNELS}")
-    print(f"📝 Posting vehicle messages to channel: {TEXT_CHANNEL_ID}")
+    if not update_squadron_data.is_running():
+        update_squadron_data.start()
+        print("✅ Squadron data update task started (runs every 6 hours)")
+    for guild_id, config in guild_configs.items():
+        print(f"📢 Guild {guild_id}: monitoring voice channels {sorted(config['monitored_voice_channels'])}, posting to {config['text_channel_id']}")
     
+    open_existing_voice_sessions()
+    if not flush_voice_sessions.is_running():
+        flush_voice_sessions.start()
+
     # Check for users already in monitored voice channels (failsafe)
-    await check_existing_voice_users()
+    async with work_priority('voice'):
+        await check_existing_voice_users()
+
+# ──────────────── PER-GUILD CONFIGURATION ────────────────
+
+async def load_guild_configs():
+    """Load every guild's configuration from Postgres into guild_configs"""
+    if db_pool is None:
+        print("❌ Database not available for loading guild configuration")
+        return
+
+    try:
+        async with unit_of_work() as conn:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS guild_config (
+                    guild_id BIGINT PRIMARY KEY,
+                    text_channel_id BIGINT,
+                    monitored_voice_channels BIGINT[] NOT NULL DEFAULT '{}'
+                )
+            """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS guild_squadrons (
+                    guild_id BIGINT NOT NULL REFERENCES guild_config (guild_id) ON DELETE CASCADE,
+                    role_name TEXT NOT NULL,
+                    squadron_name TEXT NOT NULL,
+                    squadron_url TEXT NOT NULL,
+                    PRIMARY KEY (guild_id, role_name)
+                )
+            """)
+
+            # Seed the home guild from the module defaults so existing deployments keep working
+            seeded = await conn.fetchval("""
+                INSERT INTO guild_config (guild_id, text_channel_id, monitored_voice_channels)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (guild_id) DO NOTHING
+                RETURNING guild_id
+            """, HOME_GUILD_ID, TEXT_CHANNEL_ID, MONITORED_VOICE_CHANNELS)
+            if seeded:
+                await conn.executemany("""
+                    INSERT INTO guild_squadrons (guild_id, role_name, squadron_name, squadron_url)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (guild_id, role_name) DO NOTHING
+                """, [
+                    (HOME_GUILD_ID, role_name, squadron_name, squadrons[squadron_name])
+                    for role_name, squadron_name in role_squadron_mapping.items()
+                ])
+                print(f"✅ Seeded guild configuration for home guild {HOME_GUILD_ID}")
+
+            config_rows = await conn.fetch("SELECT guild_id, text_channel_id, monitored_voice_channels FROM guild_config")
+            squadron_rows = await conn.fetch("SELECT guild_id, role_name, squadron_name, squadron_url FROM guild_squadrons")
+    except Exception as e:
+        print(f"❌ Failed to load guild configuration: {e}")
+        return
+
+    configs = {}
+    for row in config_rows:
+        configs[row['guild_id']] = {
+            'text_channel_id': row['text_channel_id'],
+            'monitored_voice_channels': set(row['monitored_voice_channels'] or []),
+            'squadrons': {},
+            'role_squadron_mapping': {}
+        }
+    for row in squadron_rows:
+        config = configs.get(row['guild_id'])
+        if config is not None:
+            config['squadrons'][row['squadron_name']] = row['squadron_url']
+            config['role_squadron_mapping'][row['role_name']] = row['squadron_name']
+
+    guild_configs.clear()
+    guild_configs.update(configs)
+    print(f"✅ Loaded configuration for {len(guild_configs)} guild(s)")
+
+# Bot-wide operator commands act on state every guild shares, so only the home guild gets them
+HOME_GUILD_ONLY_COMMANDS = {'pool_stats', 'profile', 'catalog_import'}
+synced_guilds = set()  # Guilds whose command tree has been synced since startup
+
+async def sync_guild_commands(guild_id):
+    """Copy the global commands into a guild and sync them so they show up instantly"""
+    try:
+        guild = discord.Object(id=guild_id)
+        bot.tree.copy_global_to(guild=guild)
+        if guild_id != HOME_GUILD_ID:
+            for name in HOME_GUILD_ONLY_COMMANDS:
+                bot.tree.remove_command(name, guild=guild)
+        await bot.tree.sync(guild=guild)
+        synced_guilds.add(guild_id)
+        print(f"✅ Slash commands synced to guild {guild_id}.")
+    except Exception as e:
+        print(f"❌ Failed to sync commands to guild {guild_id}: {e}")
+
+async def sync_configured_guilds():
+    """Sync every configured guild that hasn't been synced yet (guilds can be added at runtime)"""
+    for guild_id in list(guild_configs.keys() - synced_guilds):
+        await sync_guild_commands(guild_id)
+
+async def reload_guild_configs():
+    await load_guild_configs()
+    if bot.is_ready():
+        await sync_configured_guilds()
+
+@bot.event
+async def on_guild_join(guild):
+    # A guild configured before the bot joined couldn't be synced then
+    if guild.id in guild_configs and guild.id not in synced_guilds:
+        await sync_guild_commands(guild.id)
+
+async def require_home_guild(interaction, what):
+    """Refuse an operator command outside the home guild; True if it may run"""
+    if interaction.guild_id == HOME_GUILD_ID:
+        return True
+    await interaction.followup.send(f"❌ {what} is only available on the home server.", ephemeral=True)
+    return False
+
+def get_guild_config(guild_id):
+    """Get the cached configuration for a guild, or None if the guild isn't configured"""
+    return guild_configs.get(guild_id)
+
+def get_all_squadrons():
+    """All squadrons across configured guilds, deduplicated so shared squadrons are scraped once"""
+    all_squadrons = {}
+    for config in guild_configs.values():
+        all_squadrons.update(config['squadrons'])
+    return all_squadrons
+
+def get_member_squadron(member):
+    """Find the squadron a member belongs to from their roles in their guild"""
+    config = get_guild_config(member.guild.id)
+    if not config:
+        return None
+    for role in member.roles:
+        if role.name in config['role_squadron_mapping']:
+            return config['role_squadron_mapping'][role.name]
+    return None
+
+def is_monitored_voice_channel(channel):
+    """Check whether a voice channel is monitored in its guild's configuration"""
+    if channel is None:
+        return False
+    config = get_guild_config(channel.guild.id)
+    return config is not None and channel.id in config['monitored_voice_channels']
+
+def get_text_channel(guild):
+    """Get the configured vehicle message channel for a guild"""
+    config = get_guild_config(guild.id)
+    if not config or not config['text_channel_id']:
+        return None
+    return guild.get_channel(config['text_channel_id'])
 
 # ──────────────── FAILSAFE FUNCTION FOR STARTUP ────────────────
 
@@ -100,26 +690,23 @@ async def check_existing_voice_users():
     
     try:
         # Get current battle rating
-        async with db_pool.acquire() as conn:
-            br_row = await conn.fetchrow("""
-                SELECT sqb_br FROM sqb_schedule
-                WHERE NOW() BETWEEN sqb_date AND end_date
-                LIMIT 1
-            """)
-            if not br_row:
-                print("Debug: No current battle rating found for startup voice check")
-                return
-            
-            br = str(br_row['sqb_br']).rstrip('.0')
-        
-        text_channel = bot.get_channel(TEXT_CHANNEL_ID)
-        if not text_channel:
-            print(f"❌ Could not find text channel {TEXT_CHANNEL_ID} for startup voice check")
+        br = await get_current_battle_rating()
+        if not br:
+            print("Debug: No current battle rating found for startup voice check")
             return
         
         users_processed = 0
         for guild in bot.guilds:
-            for channel_id in MONITORED_VOICE_CHANNELS:
+            config = get_guild_config(guild.id)
+            if not config:
+                continue
+
+            text_channel = get_text_channel(guild)
+            if not text_channel:
+                print(f"❌ Could not find text channel {config['text_channel_id']} in guild {guild.id} for startup voice check")
+                continue
+
+            for channel_id in config['monitored_voice_channels']:
                 voice_channel = guild.get_channel(channel_id)
                 if voice_channel and voice_channel.members:
                     print(f"🔍 Startup check: Found {len(voice_channel.members)} users in voice channel {channel_id}")
@@ -129,30 +716,17 @@ async def check_existing_voice_users():
                             continue
                         
                         # Skip if user already has a message posted (avoid duplicates)
-                        if member.id in user_messages:
+                        if (guild.id, member.id) in user_messages:
                             continue
                         
-                        user_id = f"{member.name}#{member.discriminator}"
+                        user_id = member.id
                         warthunder_user = member.nick.split("|")[0].strip() if member.nick and "|" in member.nick else (member.nick or member.name)
+                        await adopt_legacy_rows([member])
                         
                         print(f"Debug: Processing startup user {member.name} in voice channel {channel_id}")
                         
                         # Get user's vehicles for current BR
-                        async with db_pool.acquire() as conn:
-                            vehicles = await conn.fetch("""
-                                SELECT vt.vehicle_name, vt.vehicle_type, n.nation_name
-                                FROM discord_data_gathered dg
-                                JOIN vehicle_table vt ON vt.vehicle_id = dg.vehicle_id
-                                JOIN nations n ON vt.nation_id = n.nation_id
-                                WHERE dg.user_id = $1 AND TRIM(TRAILING '.0' FROM vt.vehicle_br::TEXT) = $2
-                                AND vt.vehicle_name NOT ILIKE '%no vehicle%'
-                                AND vt.vehicle_name NOT ILIKE '%n/a%'
-                                ORDER BY 
-                                    CASE WHEN n.nation_id = 11 THEN 1 ELSE 0 END,
-                                    n.nation_id,
-                                    vt.vehicle_type,
-                                    vt.vehicle_name
-                            """, user_id, br)
+                        vehicles = await get_user_vehicles_for_post(user_id, br)
                         
                         # Post vehicle message (same logic as voice state update)
                         if not vehicles:
@@ -178,7 +752,7 @@ async def check_existing_voice_users():
                             
                             embed.set_footer(text="🔄 Posted on bot startup")
                             message = await text_channel.send(embed=embed)
-                            user_messages[member.id] = message.id
+                            user_messages[(guild.id, member.id)] = message.id
                             print(f"Debug: Posted 'no vehicles' startup message for {member.name}")
                         else:
                             # Group vehicles by type for better organization
@@ -237,7 +811,7 @@ async def check_existing_voice_users():
                             embed.set_footer(text=f"Total vehicles: {total_vehicles} • 🔄 Posted on bot startup")
                             
                             message = await text_channel.send(embed=embed)
-                            user_messages[member.id] = message.id
+                            user_messages[(guild.id, member.id)] = message.id
                             print(f"Debug: Posted vehicle list startup message for {member.name}")
                         
                         users_processed += 1
@@ -250,11 +824,508 @@ async def check_existing_voice_users():
     except Exception as e:
         print(f"❌ Error in startup voice check: {e}")
 
+# ──────────────── INTERACTION DEADLINES ────────────────
+
+INTERACTION_ACK_SECONDS = 3.0         # Discord drops interactions not acknowledged within this window
+INTERACTION_NEAR_MISS_SECONDS = 2.0   # Acks later than this count as near-misses
+INTERACTION_RESPONSE_SECONDS = 10.0   # Budget for the deferred answer; past it the user is left staring at "thinking"
+INTERACTION_TIGHT_SECONDS = 3.0       # With less budget than this left, helpers serve stale cache instead of querying
+
+interaction_stats = {
+    'handled': 0,
+    'near_misses': 0,
+    'expired': 0,        # Too late to acknowledge at all
+    'over_budget': 0,    # Answered after INTERACTION_RESPONSE_SECONDS
+    'stale_served': 0,
+    'max_ack_latency': 0.0
+}
+
+class InteractionBudget:
+    """Time left to answer one interaction, measured from when Discord created it"""
+
+    def __init__(self, interaction):
+        age = max((discord.utils.utcnow() - interaction.created_at).total_seconds(), 0.0)
+        self.deadline = time.monotonic() - age + INTERACTION_RESPONSE_SECONDS
+
+    def remaining(self):
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def is_tight(self):
+        return self.remaining() < INTERACTION_TIGHT_SECONDS
+
+# The budget of the interaction the current task is answering, if any
+current_budget = contextvars.ContextVar('current_budget', default=None)
+
+def budget_is_tight():
+    budget = current_budget.get()
+    return budget is not None and budget.is_tight()
+
+def budget_acquire_timeout():
+    """Pool acquire timeout for the current task, capped by the interaction budget"""
+    budget = current_budget.get()
+    if budget is None:
+        return POOL_ACQUIRE_TIMEOUT
+    return max(min(POOL_ACQUIRE_TIMEOUT, budget.remaining() - INTERACTION_TIGHT_SECONDS), 0.05)
+
+def serve_stale(cache, key):
+    """Last known value for a cache key when the interaction can't afford a query, else None"""
+    if not budget_is_tight():
+        return None
+    value = cache.get_stale(key)
+    if value is not None:
+        interaction_stats['stale_served'] += 1
+    return value
+
+def deadline_guarded(thinking=False):
+    """Acknowledge an interaction before doing any work, then run the handler within its budget.
+
+    Wraps slash commands and component callbacks alike; the handler answers with
+    interaction.followup. Acks that land late are counted as near-misses, and
+    interactions Discord already expired are dropped quietly.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            interaction = next(arg for arg in args if isinstance(arg, discord.Interaction))
+            interaction_stats['handled'] += 1
+            if not interaction.response.is_done():
+                try:
+                    await interaction.response.defer(ephemeral=True, thinking=thinking)
+                except discord.NotFound:
+                    interaction_stats['expired'] += 1
+                    print(f"⚠️ Interaction {func.__name__} expired before it could be acknowledged")
+                    return
+            ack_latency = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+            interaction_stats['max_ack_latency'] = max(interaction_stats['max_ack_latency'], ack_latency)
+            if ack_latency > INTERACTION_NEAR_MISS_SECONDS:
+                interaction_stats['near_misses'] += 1
+                print(f"⚠️ Interaction {func.__name__} acknowledged {ack_latency:.2f}s after creation (limit {INTERACTION_ACK_SECONDS}s)")
+
+            budget = InteractionBudget(interaction)
+            token = current_budget.set(budget)
+            try:
+                async with work_priority('interactive'):
+                    return await func(*args, **kwargs)
+            finally:
+                current_budget.reset(token)
+                if budget.remaining() == 0.0:
+                    interaction_stats['over_budget'] += 1
+        return wrapper
+    return decorator
+
+def format_interaction_stats():
+    return (
+        f"**Handled:** {interaction_stats['handled']} • **Near-misses:** {interaction_stats['near_misses']} • "
+        f"**Expired:** {interaction_stats['expired']}\n"
+        f"**Over budget:** {interaction_stats['over_budget']} • **Stale cache served:** {interaction_stats['stale_served']} • "
+        f"**Slowest ack:** {interaction_stats['max_ack_latency'] * 1000:.0f}ms"
+    )
+
+# ──────────────── DATABASE UNIT OF WORK ────────────────
+
+POOL_MAX_SIZE = 10
+POOL_ACQUIRE_TIMEOUT = 5.0  # Seconds to wait for a free connection before giving up
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)  # Upper bounds of the wait histogram
+
+# The connection borrowed by the unit of work running in the current task, if any
+current_connection = contextvars.ContextVar('current_connection', default=None)
+
+pool_stats = {
+    'in_use': 0,
+    'peak_in_use': 0,
+    'acquires': 0,
+    'reused': 0,
+    'timeouts': 0,
+    'wait_total': 0.0,
+    'wait_histogram': [0] * (len(POOL_WAIT_BUCKETS) + 1)  # Last bucket counts waits over the top bound
+}
+
+class PoolExhaustedError(Exception):
+    """No pooled connection became free within the acquire timeout"""
+
+# What a unit of work can fail with: no free connection, a query error, a dropped or closed
+# connection, or a query timeout
+DATABASE_ERRORS = (PoolExhaustedError, asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError)
+
+def record_pool_wait(waited):
+    pool_stats['wait_total'] += waited
+    for i, bound in enumerate(POOL_WAIT_BUCKETS):
+        if waited <= bound:
+            pool_stats['wait_histogram'][i] += 1
+            return
+    pool_stats['wait_histogram'][-1] += 1
+
+@contextlib.asynccontextmanager
+async def unit_of_work(timeout=POOL_ACQUIRE_TIMEOUT):
+    """Borrow exactly one pooled connection for an interaction or job.
+
+    Nested calls in the same task get the connection that is already borrowed
+    instead of acquiring a second one, so helpers can open their own unit of
+    work without ever holding two connections at once. Don't hand the
+    connection to tasks spawned inside the block; asyncpg connections can only
+    run one query at a time. Connections are handed out by the work scheduler
+    in priority order, within the current priority class's quota, after the
+    class's job slot (see job_slot) if it has a job limit.
+    """
+    conn = current_connection.get()
+    if conn is not None:
+        pool_stats['reused'] += 1
+        yield conn
+        return
+
+    if db_pool is None:
+        raise PoolExhaustedError("Database pool is not available")
+
+    priority = current_priority.get()
+    pool = db_pool  # Released to the pool it came from, even if db_pool is replaced meanwhile
+    async with job_slot(priority):
+        started = time.monotonic()
+        try:
+            await connection_scheduler.acquire(priority, timeout)
+            try:
+                conn = await pool.acquire(timeout=max(0.0, timeout - (time.monotonic() - started)))
+            except BaseException:
+                connection_scheduler.release(priority)
+                raise
+        except asyncio.TimeoutError:
+            pool_stats['timeouts'] += 1
+            priority_stats[priority]['timeouts'] += 1
+            raise PoolExhaustedError(
+                f"No database connection became free within {timeout}s for {priority} work "
+                f"({pool_stats['in_use']}/{POOL_MAX_SIZE} in use)"
+            ) from None
+        record_pool_wait(time.monotonic() - started)
+
+        pool_stats['acquires'] += 1
+        pool_stats['in_use'] += 1
+        pool_stats['peak_in_use'] = max(pool_stats['peak_in_use'], pool_stats['in_use'])
+        token = current_connection.set(conn)
+        try:
+            yield conn
+        finally:
+            current_connection.reset(token)
+            pool_stats['in_use'] -= 1
+            try:
+                await pool.release(conn)
+            finally:
+                connection_scheduler.release(priority)
+
+def format_pool_stats():
+    """Summarise pool occupancy and acquire waits for /pool_stats"""
+    acquires = pool_stats['acquires']
+    average_wait = pool_stats['wait_total'] / acquires if acquires else 0.0
+    lines = [
+        f"**In use:** {pool_stats['in_use']}/{POOL_MAX_SIZE} (peak {pool_stats['peak_in_use']})",
+        f"**Acquires:** {acquires} • **Reused (nested):** {pool_stats['reused']} • **Timeouts:** {pool_stats['timeouts']}",
+        f"**Average wait:** {average_wait * 1000:.2f}ms",
+        "**Wait histogram:**"
+    ]
+    lower = 0.0
+    for bound, count in zip(POOL_WAIT_BUCKETS, pool_stats['wait_histogram']):
+        lines.append(f"`{lower * 1000:>6.0f}-{bound * 1000:<6.0f}ms` {count}")
+        lower = bound
+    lines.append(f"`       >{POOL_WAIT_BUCKETS[-1] * 1000:<6.0f}ms` {pool_stats['wait_histogram'][-1]}")
+    return "\n".join(lines)
+
+@bot.tree.command(name="pool_stats", description="Show database pool occupancy and wait times")
+@app_commands.default_permissions(administrator=True)
+@deadline_guarded()
+async def pool_stats_command(interaction: discord.Interaction):
+    if not await require_home_guild(interaction, "Pool statistics"):
+        return
+    embed = discord.Embed(
+        title="🗄️ Database Pool",
+        description=format_pool_stats(),
+        color=0x607D8B
+    )
+    for cache in (schedule_cache, catalog_cache, loadout_cache):
+        embed.add_field(
+            name=f"Cache: {cache.name}",
+            value=f"{len(cache.entries)} entries • {cache.hits} hits • {cache.misses} misses",
+            inline=False
+        )
+    embed.add_field(name="Interactions", value=format_interaction_stats(), inline=False)
+    embed.add_field(name="Work priorities", value=format_priority_stats(), inline=False)
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+# ──────────────── WORK PRIORITIES ────────────────
+
+# Everything shares one event loop and one pool. Work runs in a priority class, highest first:
+# interaction handlers, then voice presence posts, then background jobs (scrapes, index
+# rebuilds, flushes, backfills). Waiting work of a higher class always gets the next free
+# connection, each class has a connection quota, and a few connections are held back for the
+# classes above, so background jobs can never hold the connections voice posts and interactions
+# need. Work that doesn't declare a class is background.
+WORK_PRIORITIES = ('interactive', 'voice', 'background')
+PRIORITY_CONNECTION_QUOTAS = {'interactive': POOL_MAX_SIZE, 'voice': POOL_MAX_SIZE, 'background': 3}
+PRIORITY_RESERVED_CONNECTIONS = {'interactive': 2, 'voice': 2, 'background': 0}  # Kept free of lower classes
+PRIORITY_JOB_LIMITS = {'interactive': None, 'voice': None, 'background': 2}  # Jobs per class in a database section at once (None = unlimited)
+
+current_priority = contextvars.ContextVar('current_priority', default='background')
+current_job = contextvars.ContextVar('current_job', default=None)  # (priority, task) of the enclosing work_priority block
+job_limited = contextvars.ContextVar('job_limited', default=True)  # False for work exempt from the job limits
+
+priority_stats = {
+    priority: {
+        'jobs': 0,
+        'job_wait_total': 0.0,
+        'job_wait_max': 0.0,
+        'acquires': 0,
+        'queued': 0,
+        'wait_total': 0.0,
+        'wait_max': 0.0,
+        'timeouts': 0,
+    }
+    for priority in WORK_PRIORITIES
+}
+
+class ConnectionScheduler:
+    """Hands out the pool's connections in priority order, within per-class quotas.
+
+    Every free connection goes to the oldest waiter of the highest class that
+    may take it; a class at its quota doesn't hold up the classes behind it.
+    Capacity matches the pool, so once a slot is granted the pool acquire
+    itself doesn't wait.
+    """
+
+    def __init__(self, capacity, quotas, reserved):
+        self.capacity = capacity
+        self.quotas = quotas
+        self.in_use = dict.fromkeys(quotas, 0)
+        self.waiters = []  # Heap of (class rank, arrival, priority, future)
+        self.arrivals = itertools.count()
+        # How many connections each class may have busy in total, leaving the reserves of the classes above it
+        self.ceilings = {
+            priority: capacity - sum(reserved[p] for p in WORK_PRIORITIES[:WORK_PRIORITIES.index(priority)])
+            for priority in WORK_PRIORITIES
+        }
+
+    def can_run(self, priority):
+        return sum(self.in_use.values()) < self.ceilings[priority] and self.in_use[priority] < self.quotas[priority]
+
+    def waiting(self, priority):
+        return sum(1 for _, _, p, future in self.waiters if p == priority and not future.done())
+
+    async def acquire(self, priority, timeout):
+        stats = priority_stats[priority]
+        started = time.monotonic()
+        if self.can_run(priority):
+            self.in_use[priority] += 1
+        else:
+            stats['queued'] += 1
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiters, (WORK_PRIORITIES.index(priority), next(self.arrivals), priority, future))
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout)
+            except BaseException:
+                if future.done() and not future.cancelled():
+                    self.release(priority)  # Granted just as we gave up
+                else:
+                    future.cancel()
+                raise
+        waited = time.monotonic() - started
+        stats['acquires'] += 1
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+
+    def release(self, priority):
+        self.in_use[priority] -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        blocked = []
+        while self.waiters and sum(self.in_use.values()) < self.capacity:
+            entry = heapq.heappop(self.waiters)
+            priority, future = entry[2], entry[3]
+            if future.done():
+                continue  # Timed out or cancelled
+            if not self.can_run(priority):
+                blocked.append(entry)
+                continue
+            self.in_use[priority] += 1
+            future.set_result(None)
+        for entry in blocked:
+            heapq.heappush(self.waiters, entry)
+
+connection_scheduler = ConnectionScheduler(POOL_MAX_SIZE, PRIORITY_CONNECTION_QUOTAS, PRIORITY_RESERVED_CONNECTIONS)
+job_slots = {priority: asyncio.Semaphore(limit) for priority, limit in PRIORITY_JOB_LIMITS.items() if limit}
+
+@contextlib.asynccontextmanager
+async def job_slot(priority):
+    """Hold one of a limited class's job slots for a database section.
+
+    Taken by unit_of_work, so a job only counts against its class's limit while
+    it works with the database, never across scrapes, member paging or sleeps.
+    Unlimited classes and exempt work (see work_priority) pass straight through.
+    """
+    slots = job_slots.get(priority) if job_limited.get() else None
+    if slots is None:
+        yield
+        return
+
+    stats = priority_stats[priority]
+    started = time.monotonic()
+    await slots.acquire()
+    waited = time.monotonic() - started
+    stats['jobs'] += 1
+    stats['job_wait_total'] += waited
+    stats['job_wait_max'] = max(stats['job_wait_max'], waited)
+    try:
+        yield
+    finally:
+        slots.release()
+
+@contextlib.asynccontextmanager
+async def work_priority(priority, job_limit=True):
+    """Run the enclosed work in a priority class.
+
+    Re-entering the class the current task already runs in is free, so a job
+    can call helpers that declare the same class. job_limit=False exempts the
+    enclosed work from the class's job slots, for work that mustn't queue
+    behind other jobs, like the writes on shutdown.
+    """
+    task = asyncio.current_task()
+    if current_job.get() == (priority, task):
+        yield
+        return
+
+    priority_token = current_priority.set(priority)
+    job_token = current_job.set((priority, task))
+    limit_token = job_limited.set(job_limit)
+    try:
+        yield
+    finally:
+        job_limited.reset(limit_token)
+        current_job.reset(job_token)
+        current_priority.reset(priority_token)
+
+def prioritized(priority):
+    """Decorator running a coroutine function in a priority class (see work_priority)"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with work_priority(priority):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def spawn_background(job, *args):
+    """Start job(*args) as a background task, whatever class the caller is running in"""
+    async def run():
+        # The task starts with a copy of the caller's context; drop what belongs to the caller, above
+        # all its connection, which the caller may release (or be using) while the job runs
+        current_connection.set(None)
+        current_budget.set(None)
+        current_job.set(None)
+        current_priority.set('background')
+        job_limited.set(True)
+        async with work_priority('background'):
+            return await job(*args)
+    return asyncio.get_running_loop().create_task(run())
+
+def format_priority_stats():
+    lines = []
+    for priority in WORK_PRIORITIES:
+        stats = priority_stats[priority]
+        average_wait = stats['wait_total'] / stats['acquires'] if stats['acquires'] else 0.0
+        line = (
+            f"**{priority}:** {connection_scheduler.in_use[priority]}/{PRIORITY_CONNECTION_QUOTAS[priority]} conns, "
+            f"{connection_scheduler.waiting(priority)} waiting • queued {stats['queued']}/{stats['acquires']} • "
+            f"wait avg {average_wait * 1000:.1f}ms, max {stats['wait_max'] * 1000:.0f}ms • timeouts {stats['timeouts']}"
+        )
+        if priority in job_slots:
+            average_job_wait = stats['job_wait_total'] / stats['jobs'] if stats['jobs'] else 0.0
+            line += (f"\n  job DB sections {stats['jobs']} (max {PRIORITY_JOB_LIMITS[priority]} at once), "
+                     f"slot wait avg {average_job_wait * 1000:.0f}ms, max {stats['job_wait_max'] * 1000:.0f}ms")
+        lines.append(line)
+    return "\n".join(lines)
+
+# ──────────────── LEADER ELECTION FOR SINGLETON JOBS ────────────────
+
+# Every instance serves interactions, but only the instance holding this advisory lock runs
+# singleton background jobs (squadron scraping, and any future role sync / reconciliation).
+LEADER_LOCK_KEY = 0x57544254  # "WTBT"
+LEADER_HEARTBEAT_SECONDS = 15
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+leader_conn = None
+is_leader = False
+
+def leader_only(job):
+    """Decorator for background jobs that must run on exactly one instance"""
+    @functools.wraps(job)
+    async def wrapper(*args, **kwargs):
+        if not is_leader:
+            print(f"Debug: Skipping {job.__name__}, {INSTANCE_ID} is not the leader")
+            return None
+        return await job(*args, **kwargs)
+    return wrapper
+
+async def step_down():
+    global leader_conn, is_leader
+    if is_leader:
+        print(f"⚠️ {INSTANCE_ID} lost leadership")
+    is_leader = False
+    if leader_conn is not None:
+        try:
+            await leader_conn.close(timeout=5)
+        except Exception:
+            leader_conn.terminate()
+    leader_conn = None
+
+@tasks.loop(seconds=LEADER_HEARTBEAT_SECONDS)
+async def leader_election():
+    """Hold (or try to take) the leader advisory lock on a dedicated connection.
+
+    The lock is session-level, so it lives exactly as long as leader_conn: if this
+    instance dies or its connection drops, Postgres releases the lock and another
+    instance picks it up on its next heartbeat.
+    """
+    global leader_conn, is_leader
+
+    if leader_conn is not None and not leader_conn.is_closed():
+        try:
+            await leader_conn.fetchval("SELECT 1", timeout=5)
+        except Exception as e:
+            print(f"❌ Leader election connection failed heartbeat: {e}")
+            await step_down()
+    elif is_leader:
+        await step_down()
+
+    if is_leader:
+        return
+
+    try:
+        if leader_conn is None or leader_conn.is_closed():
+            leader_conn = await asyncpg.connect(
+                host=DB_HOST,
+                port=DB_PORT,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                database=DB_NAME
+            )
+        acquired = await leader_conn.fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_KEY, timeout=5)
+    except Exception as e:
+        print(f"❌ Leader election failed: {e}")
+        await step_down()
+        return
+
+    if acquired:
+        is_leader = True
+        print(f"👑 {INSTANCE_ID} is now the leader for singleton jobs")
+        # Run singleton jobs now instead of waiting out their interval after a failover
+        if update_squadron_data.is_running():
+            update_squadron_data.restart()
+        if unadopted_user_keys:
+            spawn_background(backfill_discord_ids)
+
 # ──────────────── SQUADRON DATA CACHING SYSTEM ────────────────
 
 @tasks.loop(hours=6)
+@leader_only
+@prioritized('background')
 async def update_squadron_data():
-    """Update squadron member data every 6 hours"""
+    """Update squadron member data every 6 hours (leader instance only)"""
     if db_pool is None:
         print("❌ Database not available for squadron data update")
         return
@@ -262,46 +1333,36 @@ async def update_squadron_data():
     print(f"🔄 Starting squadron data update at {datetime.now()}")
     
     try:
-        async with db_pool.acquire() as conn:
-            # Create the squadron_cache table if it doesn't exist
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS squadron_cache (
-                    player_name TEXT PRIMARY KEY,
-                    squadron_name TEXT NOT NULL,
-                    points INTEGER NOT NULL,
-                    activity INTEGER NOT NULL,
-                    last_updated TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-                )
-            """)
+        # Scrape data from all squadrons before touching the table, so a slow or failed
+        # scrape never leaves squadron_cache empty
+        scraped = {}
+        for squadron_name, squadron_url in get_all_squadrons().items():
+            print(f"🔍 Scraping {squadron_name}...")
+            players_data = await scrape_squadron_data(squadron_url, squadron_name)
             
-            # Clear old data
-            await conn.execute("DELETE FROM squadron_cache")
-            print("🗑️ Cleared old squadron cache data")
+            if players_data:
+                scraped[squadron_name] = players_data
+                print(f"✅ Scraped {len(players_data)} players from {squadron_name}")
+            else:
+                print(f"❌ Failed to scrape data from {squadron_name}, keeping its previous data")
+
+        async with unit_of_work() as conn:
+            # Create the squadron_cache table if it doesn't exist
+            await conn.execute(SQUADRON_CACHE_DDL)
             
-            # Scrape data from all squadrons
-            total_players = 0
-            for squadron_name, squadron_url in squadrons.items():
-                print(f"🔍 Scraping {squadron_name}...")
-                players_data = await scrape_squadron_data(squadron_url, squadron_name)
-                
-                if players_data:
-                    # Insert data into cache table
-                    for player_data in players_data:
-                        await conn.execute("""
-                            INSERT INTO squadron_cache (player_name, squadron_name, points, activity)
-                            VALUES ($1, $2, $3, $4)
-                            ON CONFLICT (player_name) DO UPDATE SET
-                                squadron_name = EXCLUDED.squadron_name,
-                                points = EXCLUDED.points,
-                                activity = EXCLUDED.activity,
-                                last_updated = NOW()
-                        """, player_data['name'], squadron_name, player_data['points'], player_data['activity'])
-                    
-                    total_players += len(players_data)
-                    print(f"✅ Cached {len(players_data)} players from {squadron_name}")
-                else:
-                    print(f"❌ Failed to scrape data from {squadron_name}")
+            if not scraped:
+                return
+
+            # Swap old data for new in one transaction, readers see either the old or the new snapshot
+            async with conn.transaction():
+                await conn.execute(SQUADRON_CACHE_DELETE_SQL, list(scraped))
+                await conn.executemany(SQUADRON_CACHE_UPSERT_SQL, [
+                    (player_data['name'], squadron_name, player_data['points'], player_data['activity'])
+                    for squadron_name, players_data in scraped.items()
+                    for player_data in players_data
+                ])
             
+            total_players = sum(len(players_data) for players_data in scraped.values())
             print(f"✅ Squadron data update complete! Cached {total_players} total players")
             
     except Exception as e:
@@ -318,163 +1379,288 @@ async def scrape_squadron_data(squadron_url, squadron_name):
         async with session.get(squadron_url) as response:
             if response.status == 200:
                 html = await response.text()
-                soup = BeautifulSoup(html, 'html.parser')
+            else:
+                return None
+
+    # Parsing a full squadron page takes long enough to delay gateway heartbeats, so it runs off the loop
+    return await run_cpu_bound(parse_squadron_html, html)
+
+def parse_squadron_html(html):
+    """Parse player name, points and activity out of a squadron page (runs in the process pool)"""
+    soup = BeautifulSoup(html, 'html.parser')
+    
+    players_data = []
+    
+    # Find all grid items
+    grid_items = soup.find_all('div', class_='squadrons-members__grid-item')
+    
+    # Process grid items in groups of 6 (each player has 6 columns)
+    for i in range(0, len(grid_items), 6):
+        if i + 5 < len(grid_items):  # Ensure we have all 6 columns
+            # Column 2: Player name
+            player_div = grid_items[i + 1]
+            player_link = player_div.find('a')
+            
+            if player_link:
+                player_name = player_link.get_text(strip=True)
                 
-                players_data = []
+                # Clean platform suffixes from player names
+                player_name = clean_player_name(player_name)
                 
-                # Find all grid items
-                grid_items = soup.find_all('div', class_='squadrons-members__grid-item')
+                # Column 3: Personal clan rating (points)
+                points_div = grid_items[i + 2]
+                points_text = points_div.get_text(strip=True)
+                points = int(points_text) if points_text.isdigit() else 0
                 
-                # Process grid items in groups of 6 (each player has 6 columns)
-                for i in range(0, len(grid_items), 6):
-                    if i + 5 < len(grid_items):  # Ensure we have all 6 columns
-                        # Column 2: Player name
-                        player_div = grid_items[i + 1]
-                        player_link = player_div.find('a')
-                        
-                        if player_link:
-                            player_name = player_link.get_text(strip=True)
-                            
-                            # Clean platform suffixes from player names
-                            player_name = clean_player_name(player_name)
-                            
-                            # Column 3: Personal clan rating (points)
-                            points_div = grid_items[i + 2]
-                            points_text = points_div.get_text(strip=True)
-                            points = int(points_text) if points_text.isdigit() else 0
-                            
-                            # Column 4: Activity
-                            activity_div = grid_items[i + 3]
-                            activity_text = activity_div.get_text(strip=True)
-                            activity = int(activity_text) if activity_text.isdigit() else 0
-                            
-                            players_data.append({
-                                'name': player_name,
-                                'points': points,
-                                'activity': activity
-                            })
+                # Column 4: Activity
+                activity_div = grid_items[i + 3]
+                activity_text = activity_div.get_text(strip=True)
+                activity = int(activity_text) if activity_text.isdigit() else 0
                 
-                return players_data
-            else:
-                return None
+                players_data.append({
+                    'name': player_name,
+                    'points': points,
+                    'activity': activity
+                })
+    
+    return players_data
 
 async def get_squadron_data_for_user(member, warthunder_user):
-    """Get squadron points and activity for a user from cache"""
-    squadron_name = None
-    
+    """Get squadron points and activity for a user from the in-memory player name index"""
     # Check user's roles to determine which squadron they belong to
-    for role in member.roles:
-        if role.name in role_squadron_mapping:
-            squadron_name = role_squadron_mapping[role.name]
-            break
+    squadron_name = get_member_squadron(member)
     
     if not squadron_name:
         print(f"Debug: No squadron role found for {member.name}")
         return None
-    
-    if db_pool is None:
-        print("Debug: Database not available for squadron data lookup")
+
+    if not player_name_index.has_squadron(squadron_name):
+        # Nothing scraped for this squadron yet; fetch it in the background rather than on the join path
+        print(f"Debug: No squadron data indexed for {squadron_name}, scheduling a scrape")
+        schedule_squadron_scrape(squadron_name)
         return None
-    
-    try:
-        async with db_pool.acquire() as conn:
-            # Get data from cache table
-            row = await conn.fetchrow("""
-                SELECT squadron_name, points, activity, last_updated
-                FROM squadron_cache
-                WHERE player_name = $1 AND squadron_name = $2
-            """, clean_player_name(warthunder_user), squadron_name)
-            
-            if row:
-                print(f"Debug: Found cached data for {warthunder_user} in {squadron_name} - Points: {row['points']}, Activity: {row['activity']}")
-                return {
-                    'squadron': row['squadron_name'],
-                    'points': str(row['points']),
-                    'activity': str(row['activity'])
-                }
-            else:
-                print(f"Debug: No cached data found for {warthunder_user} in {squadron_name}")
-                # Check if cache is empty (might need manual update)
-                cache_count = await conn.fetchval("SELECT COUNT(*) FROM squadron_cache WHERE squadron_name = $1", squadron_name)
-                if cache_count == 0:
-                    print(f"Debug: Cache is empty for {squadron_name}, triggering manual update")
-                    # Trigger a manual update for this squadron
-                    squadron_url = squadrons.get(squadron_name)
-                    if squadron_url:
-                        players_data = await scrape_squadron_data(squadron_url, squadron_name)
-                        if players_data:
-                            for player_data in players_data:
-                                await conn.execute("""
-                                    INSERT INTO squadron_cache (player_name, squadron_name, points, activity)
-                                    VALUES ($1, $2, $3, $4)
-                                    ON CONFLICT (player_name) DO UPDATE SET
-                                        squadron_name = EXCLUDED.squadron_name,
-                                        points = EXCLUDED.points,
-                                        activity = EXCLUDED.activity,
-                                        last_updated = NOW()
-                                """, player_data['name'], squadron_name, player_data['points'], player_data['activity'])
-                            
-                            # Try to get the data again
-                            row = await conn.fetchrow("""
-                                SELECT squadron_name, points, activity
-                                FROM squadron_cache
-                                WHERE player_name = $1 AND squadron_name = $2
-                            """, clean_player_name(warthunder_user), squadron_name)
-                            
-                            if row:
-                                return {
-                                    'squadron': row['squadron_name'],
-                                    'points': str(row['points']),
-                                    'activity': str(row['activity'])
-                                }
-                
-                return None
-                
-    except Exception as e:
-        print(f"Debug: Error getting squadron data from cache: {e}")
+
+    stats, player_key, match_type = player_name_index.resolve(squadron_name, warthunder_user, member_player_map.get(member.id))
+    if stats is None:
+        print(f"Debug: No squadron data found for {warthunder_user} in {squadron_name}")
         return None
 
-@bot.tree.command(name="sqb_queue", description="Select your vehicles for the current battle rating", guild=discord.Object(id=779462911713607690))
-async def sqb_queue(interaction: discord.Interaction):
-    br = await get_current_battle_rating()
-    if not br:
-        await interaction.response.send_message("❌ Could not determine current battle rating.", ephemeral=True)
-        return
-
-    all_vehicles = await get_all_vehicles_for_br(br)
-    if not all_vehicles:
-        await interaction.response.send_message(f"❌ No vehicles found for BR {br}.", ephemeral=True)
-        return
-
-    # Debug: Print vehicle types to see what we're getting
-    print(f"Debug: Found {len(all_vehicles)} vehicles for BR {br}")
-    vehicle_types_found = set()
-    for v in all_vehicles:
-        vehicle_types_found.add(v['vehicle_type'].lower())
-    print(f"Debug: Vehicle types found: {vehicle_types_found}")
-
-    vehicles_by_type = {'ground': [], 'spaa': [], 'air': [], 'heli': []}
-    for v in all_vehicles:
-        vtype = v['vehicle_type'].lower()
-        # Handle different possible vehicle type names
-        if vtype in ['tank', 'ground', 'medium tank', 'heavy tank', 'light tank', 'tank destroyer']:
-            vehicles_by_type['ground'].append(v)
-        elif vtype in ['spaa', 'anti-aircraft']:
-            vehicles_by_type['spaa'].append(v)
-        elif vtype in ['aircraft', 'air', 'fighter', 'bomber', 'attacker']:
-            vehicles_by_type['air'].append(v)
-        elif vtype in ['helicopter', 'heli']:
-            vehicles_by_type['heli'].append(v)
-        else:
-            # If we don't recognize the type, put it in ground as default
-            print(f"Debug: Unknown vehicle type '{vtype}' for {v['vehicle_name']}, adding to ground")
-            vehicles_by_type['ground'].append(v)
+    print(f"Debug: Found {match_type} squadron data for {warthunder_user} in {squadron_name} - Points: {stats['points']}, Activity: {stats['activity']}")
+    # Remember new matches, and upgrade a remembered near-match once the name matches exactly
+    remembered = member_player_map.get(member.id)
+    if remembered is None or remembered[:2] != (squadron_name, player_key) or (match_type == 'exact' and remembered[2] != 'exact'):
+        remember_member_player(member.id, squadron_name, player_key, match_type)
+    return {
+        'squadron': squadron_name,
+        'points': str(stats['points']),
+        'activity': str(stats['activity'])
+    }
+
+# ──────────────── PLAYER NAME INDEX ────────────────
+
+PLATFORM_SUFFIXES = ('@live', '@psn', '@xbox', '@steam', '@epic')
+FUZZY_MATCH_THRESHOLD = 0.5  # Minimum trigram Jaccard similarity for a near-match
+
+def normalize_player_name(player_name):
+    """Canonical form used to compare player names: NFKC, casefolded, no platform suffix or whitespace"""
+    if not player_name:
+        return ''
+    name = unicodedata.normalize('NFKC', player_name).casefold()
+    # Drop whitespace and invisible format characters (zero-width spaces, joiners, ...)
+    name = ''.join(ch for ch in name if not ch.isspace() and unicodedata.category(ch) != 'Cf')
+    for suffix in PLATFORM_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return name
+
+def name_trigrams(player_key):
+    padded = f"  {player_key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class PlayerNameIndex:
+    """Normalized squadron player names with a trigram index for near-matches.
+
+    Rebuilt from squadron_cache after every refresh; lookups never touch the database.
+    """
+
+    def __init__(self):
+        self.players = {}   # squadron -> {player key -> stats}
+        self.trigrams = {}  # squadron -> {trigram -> set of player keys}
+        self.loaded = False
+
+    def build(self, rows):
+        players = {}
+        trigrams = {}
+        for row in rows:
+            player_key = normalize_player_name(row['player_name'])
+            if not player_key:
+                continue
+            squadron = row['squadron_name']
+            players.setdefault(squadron, {})[player_key] = {
+                'player_name': row['player_name'],
+                'points': row['points'],
+                'activity': row['activity']
+            }
+            postings = trigrams.setdefault(squadron, {})
+            for trigram in name_trigrams(player_key):
+                postings.setdefault(trigram, set()).add(player_key)
+        # Swap in whole dicts so readers never see a half-built index
+        self.players = players
+        self.trigrams = trigrams
+        self.loaded = True
+
+    def has_squadron(self, squadron):
+        return not self.loaded or bool(self.players.get(squadron))
+
+    def squadron_players(self, squadron):
+        return self.players.get(squadron, {})
+
+    def fuzzy_match(self, squadron, player_key):
+        """Best near-match for a player key by trigram Jaccard similarity, or None"""
+        postings = self.trigrams.get(squadron)
+        if not postings:
+            return None
+        query = name_trigrams(player_key)
+        shared = collections.Counter()
+        for trigram in query:
+            shared.update(postings.get(trigram, ()))
+        best_key, best_score = None, FUZZY_MATCH_THRESHOLD
+        for candidate, overlap in shared.items():
+            score = overlap / (len(query) + len(name_trigrams(candidate)) - overlap)
+            if score >= best_score:
+                best_key, best_score = candidate, score
+        return best_key
+
+    def resolve(self, squadron, warthunder_user, mapped=None, fuzzy=True):
+        """Find a member's stats: exact name, then their remembered mapping, then (if fuzzy) a near-match.
+
+        Returns (stats, player key, match type) or (None, None, None).
+        """
+        players = self.players.get(squadron, {})
+        player_key = normalize_player_name(warthunder_user)
+        if player_key in players:
+            return players[player_key], player_key, 'exact'
+        if mapped and mapped[0] == squadron and mapped[1] in players:
+            return players[mapped[1]], mapped[1], 'mapped'
+        fuzzy_key = self.fuzzy_match(squadron, player_key) if fuzzy and player_key else None
+        if fuzzy_key:
+            return players[fuzzy_key], fuzzy_key, 'fuzzy'
+        return None, None, None
+
+SCRAPE_REQUEST_CHANNEL = 'wtbot_scrape_request'  # Non-leaders ask the leader to scrape a squadron here
+SQUADRON_SCRAPE_COOLDOWN_SECONDS = 600  # Per squadron, whatever the last scrape returned
+
+player_name_index = PlayerNameIndex()
+member_player_map = {}  # member ID -> (squadron name, player key, match type) remembered from earlier matches
+scrapes_in_flight = set()
+scrape_cooldowns = {}  # squadron name -> monotonic time before which it isn't scraped or requested again
+
+async def refresh_player_name_index():
+    """Rebuild the player name index from squadron_cache"""
+    try:
+        async with unit_of_work() as conn:
+            rows = await conn.fetch(SQUADRON_CACHE_ALL_SQL)
+    except Exception as e:
+        print(f"❌ Failed to load squadron cache for the player name index: {e}")
+        return
+    player_name_index.build(await run_in_thread(list, rows))
+    print(f"✅ Player name index rebuilt with {len(rows)} players")
+
+async def load_member_player_map():
+    try:
+        async with unit_of_work() as conn:
+            rows = await conn.fetch(MEMBER_PLAYER_MAP_ALL_SQL)
+    except Exception as e:
+        print(f"❌ Failed to load member to player mapping: {e}")
+        return
+    member_player_map.clear()
+    member_player_map.update({
+        row['member_id']: (row['squadron_name'], row['player_key'], row['match_type']) for row in rows
+    })
+
+def remember_member_player(member_id, squadron_name, player_key, match_type):
+    """Persist which squadron player a member resolved to, without blocking the caller"""
+    member_player_map[member_id] = (squadron_name, player_key, match_type)
+
+    async def persist():
+        try:
+            async with unit_of_work() as conn:
+                await conn.execute(MEMBER_PLAYER_MAP_UPSERT_SQL, member_id, squadron_name, player_key, match_type)
+        except Exception as e:
+            print(f"❌ Failed to persist player mapping for member {member_id}: {e}")
+
+    spawn_background(persist)
+
+def schedule_squadron_scrape(squadron_name):
+    """Scrape one squadron in the background, on the leader and at most once per cooldown.
+
+    Other instances pass the request to the leader over NOTIFY; every instance
+    picks up the result through the squadron_cache notification.
+    """
+    squadron_url = get_all_squadrons().get(squadron_name)
+    now = time.monotonic()
+    if not squadron_url or squadron_name in scrapes_in_flight or now < scrape_cooldowns.get(squadron_name, 0):
+        return
+    # Set before the scrape so an empty or failed result doesn't get retried on every member join
+    scrape_cooldowns[squadron_name] = now + SQUADRON_SCRAPE_COOLDOWN_SECONDS
+
+    if not is_leader:
+        async def request_scrape():
+            try:
+                async with unit_of_work() as conn:
+                    await conn.execute("SELECT pg_notify($1, $2)", SCRAPE_REQUEST_CHANNEL, squadron_name)
+            except Exception as e:
+                print(f"❌ Failed to ask the leader to scrape {squadron_name}: {e}")
+
+        spawn_background(request_scrape)
+        return
+
+    scrapes_in_flight.add(squadron_name)
+
+    async def scrape():
+        try:
+            players_data = await scrape_squadron_data(squadron_url, squadron_name)
+            if not players_data:
+                return
+            async with unit_of_work() as conn:
+                await conn.executemany(SQUADRON_CACHE_UPSERT_SQL, [
+                    (player_data['name'], squadron_name, player_data['points'], player_data['activity'])
+                    for player_data in players_data
+                ])
+            # The squadron_cache NOTIFY rebuilds the index, but don't wait for it on this instance
+            await refresh_player_name_index()
+        except Exception as e:
+            print(f"❌ Background scrape of {squadron_name} failed: {e}")
+        finally:
+            scrapes_in_flight.discard(squadron_name)
+
+    spawn_background(scrape)
+
+def on_scrape_request(connection, pid, channel, payload):
+    """Scrape a squadron another instance asked for, if this instance is the leader (called by asyncpg on NOTIFY)"""
+    if is_leader:
+        schedule_squadron_scrape(payload)
+
+@bot.tree.command(name="sqb_queue", description="Select your vehicles for the current battle rating")
+@deadline_guarded()
+async def sqb_queue(interaction: discord.Interaction):
+    br = await get_current_battle_rating()
+    if not br:
+        await interaction.followup.send("❌ Could not determine current battle rating.", ephemeral=True)
+        return
+
+    menus = await get_vehicle_menus(br)
+    if not any(menu.vehicle_ids for menu in menus.values()):
+        await interaction.followup.send(f"❌ No vehicles found for BR {br}.", ephemeral=True)
+        return
 
     # Debug: Print how many vehicles per type
-    for vtype, vehicles in vehicles_by_type.items():
-        print(f"Debug: {vtype}: {len(vehicles)} vehicles")
+    for vtype, menu in menus.items():
+        print(f"Debug: {vtype}: {len(menu.vehicle_ids)} vehicles on {len(menu.pages)} page(s)")
 
-    user_id = f"{interaction.user.name}#{interaction.user.discriminator}"
+    user_id = interaction.user.id
+    await adopt_legacy_rows([interaction.user])
     if interaction.user.nick and "|" in interaction.user.nick:
         warthunder_user = interaction.user.nick.split("|")[0].strip()
     elif interaction.user.nick:
@@ -482,59 +1668,50 @@ async def sqb_queue(interaction: discord.Interaction):
     else:
         warthunder_user = interaction.user.name
 
-    existing_vehicle_ids = await get_user_vehicle_ids(user_id, br)
-    selected_ids = {str(v_id) for v_id in existing_vehicle_ids}
-    await interaction.response.defer(ephemeral=True)
+    selected_ids = await get_user_vehicle_ids(user_id, br)
+
+    async def show_next_selection(interaction, user_id, warthunder_user, br, menus, selected_ids, index=0):
+        # Show every category in turn, even if empty (let user see there are no vehicles)
+        if index < len(MENU_CATEGORY_ORDER):
+            current_type = MENU_CATEGORY_ORDER[index]
+            print(f"Debug: Processing {current_type} with {len(menus[current_type].vehicle_ids)} vehicles")
 
-    async def show_next_selection(interaction, user_id, warthunder_user, br, vehicles_by_type, selected_ids, index=0):
-        type_order = ['ground', 'spaa', 'air', 'heli']
-        
-        # Find the next type that has vehicles, but don't skip any types automatically
-        while index < len(type_order):
-            current_type = type_order[index]
-            vehicles = vehicles_by_type.get(current_type, [])
-            
-            print(f"Debug: Processing {current_type} with {len(vehicles)} vehicles")
-            
-            # Always show the selection, even if empty (let user see there are no vehicles)
             view = VehicleSelectionView(
-                vehicles,
+                menus[current_type],
                 user_id,
                 warthunder_user,
-                is_air=(current_type == 'air'),
-                next_callback=functools.partial(show_next_selection, interaction, user_id, warthunder_user, br, vehicles_by_type, selected_ids, index + 1),
-                selected_ids=selected_ids
+                br,
+                selected_ids,
+                next_callback=functools.partial(show_next_selection, interaction, user_id, warthunder_user, br, menus, selected_ids, index + 1)
             )
-
-            if vehicles:
-                message = f"📋 Select your **{current_type.upper()}** vehicles for BR {br}:"
-            else:
-                message = f"📋 No **{current_type.upper()}** vehicles available for BR {br}. Click to continue."
-
-            await interaction.followup.send(message, view=view, ephemeral=True)
+            await interaction.followup.send(view.content(), view=view, ephemeral=True)
             return
         
         # All vehicle selections complete - check if user is in any monitored voice channel
         member = interaction.user
-        if member.voice and member.voice.channel and member.voice.channel.id in MONITORED_VOICE_CHANNELS:
+        if member.voice and is_monitored_voice_channel(member.voice.channel):
             await post_user_vehicles_and_cleanup(member, user_id, warthunder_user, br)
             return  # Don't send the completion message since we posted the vehicle message
         
         # If we've gone through all types
         await interaction.followup.send("✅ All vehicle selections have been saved.", ephemeral=True)
 
-    await show_next_selection(interaction, user_id, warthunder_user, br, vehicles_by_type, selected_ids)
+    await show_next_selection(interaction, user_id, warthunder_user, br, menus, selected_ids)
 
 @bot.event
+@prioritized('voice')
 async def on_voice_state_update(member, before, after):
+    record_voice_transition(member, before, after)
+
     # Check if user is leaving any monitored voice channel
-    if before.channel and before.channel.id in MONITORED_VOICE_CHANNELS:
+    message_key = (member.guild.id, member.id)
+    if is_monitored_voice_channel(before.channel):
         # User left a monitored channel, delete their message if it exists
-        if member.id in user_messages:
+        if message_key in user_messages:
             try:
-                channel = bot.get_channel(TEXT_CHANNEL_ID)
+                channel = get_text_channel(member.guild)
                 if channel:
-                    message = await channel.fetch_message(user_messages[member.id])
+                    message = await channel.fetch_message(user_messages[message_key])
                     await message.delete()
                     print(f"Debug: Deleted message for {member.name} who left voice channel {before.channel.id}")
             except discord.NotFound:
@@ -543,10 +1720,10 @@ async def on_voice_state_update(member, before, after):
                 print(f"Debug: Error deleting message for {member.name}: {e}")
             finally:
                 # Remove from tracking regardless of deletion success
-                del user_messages[member.id]
+                del user_messages[message_key]
     
     # Only trigger when user joins any monitored voice channel
-    if after.channel is None or after.channel.id not in MONITORED_VOICE_CHANNELS:
+    if not is_monitored_voice_channel(after.channel):
         return
     
     # Don't trigger if user was already in the same channel
@@ -555,41 +1732,22 @@ async def on_voice_state_update(member, before, after):
 
     print(f"Debug: {member.name} joined monitored voice channel {after.channel.id}")
 
-    channel = bot.get_channel(TEXT_CHANNEL_ID)
+    channel = get_text_channel(member.guild)
     if channel is None:
-        print(f"Debug: Could not find text channel {TEXT_CHANNEL_ID}")
+        print(f"Debug: Could not find text channel for guild {member.guild.id}")
         return
 
-    user_id = f"{member.name}#{member.discriminator}"
+    user_id = member.id
     warthunder_user = member.nick.split("|")[0].strip() if member.nick and "|" in member.nick else (member.nick or member.name)
+    await adopt_legacy_rows([member])
 
-    async with db_pool.acquire() as conn:
-        br_row = await conn.fetchrow("""
-            SELECT sqb_br FROM sqb_schedule
-            WHERE NOW() BETWEEN sqb_date AND end_date
-            LIMIT 1
-        """)
-        if not br_row:
-            print("Debug: No current battle rating found in schedule")
-            return
+    br = await get_current_battle_rating()
+    if not br:
+        print("Debug: No current battle rating found in schedule")
+        return
 
-        br = str(br_row['sqb_br']).rstrip('.0')
-        
-        # Query using user_id to match how vehicles are stored
-        vehicles = await conn.fetch("""
-            SELECT vt.vehicle_name, vt.vehicle_type, n.nation_name
-            FROM discord_data_gathered dg
-            JOIN vehicle_table vt ON vt.vehicle_id = dg.vehicle_id
-            JOIN nations n ON vt.nation_id = n.nation_id
-            WHERE dg.user_id = $1 AND TRIM(TRAILING '.0' FROM vt.vehicle_br::TEXT) = $2
-            AND vt.vehicle_name NOT ILIKE '%no vehicle%'
-            AND vt.vehicle_name NOT ILIKE '%n/a%'
-            ORDER BY 
-                CASE WHEN n.nation_id = 11 THEN 1 ELSE 0 END,
-                n.nation_id,
-                vt.vehicle_type,
-                vt.vehicle_name
-        """, user_id, br)
+    # Query using user_id to match how vehicles are stored
+    vehicles = await get_user_vehicles_for_post(user_id, br)
 
     if not vehicles:
         embed = discord.Embed(
@@ -614,7 +1772,7 @@ async def on_voice_state_update(member, before, after):
         
         message = await channel.send(embed=embed)
         # Store the message ID for potential deletion
-        user_messages[member.id] = message.id
+        user_messages[message_key] = message.id
         print(f"Debug: Posted 'no vehicles' message for {member.name}")
     else:
         # Group vehicles by type for better organization
@@ -674,102 +1832,716 @@ async def on_voice_state_update(member, before, after):
         
         message = await channel.send(embed=embed)
         # Store the message ID for potential deletion
-        user_messages[member.id] = message.id
+        user_messages[message_key] = message.id
         print(f"Debug: Posted vehicle list message for {member.name}")
 
+# ──────────────── VOICE SESSION ANALYTICS ────────────────
+
+VOICE_FLUSH_BATCH_SIZE = 200      # Flush as soon as this many finished sessions are buffered
+VOICE_FLUSH_SECONDS = 60          # ...or at least this often
+VOICE_BUFFER_MAX_ROWS = 20000     # While Postgres is unreachable, keep at most this many (oldest dropped first)
+VOICE_SESSION_COLUMNS = ['guild_id', 'member_id', 'channel_id', 'joined_at', 'left_at']
+
+open_voice_sessions = {}  # (guild ID, member ID) -> (channel ID, joined at) for members in monitored channels
+
+class VoiceSessionBuffer:
+    """Write-behind buffer of finished voice sessions.
+
+    The voice handler only appends to a list; rows reach Postgres in batches
+    via COPY, on size, on a timer and at shutdown. Every instance sees the same
+    voice events, so only the leader's rows are written and the others' are
+    discarded at each flush; instances still track open sessions so a new
+    leader carries on from the sessions it already saw start.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.flushing = None
+        self.flushed = 0
+        self.dropped = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= VOICE_FLUSH_BATCH_SIZE and (self.flushing is None or self.flushing.done()):
+            self.flushing = spawn_background(self.flush)
+
+    async def flush(self):
+        if not self.rows or db_pool is None:
+            return
+        if not is_leader:
+            self.rows.clear()
+            return
+        rows, self.rows = self.rows, []
+        try:
+            async with unit_of_work() as conn:
+                await conn.copy_records_to_table('voice_sessions', records=rows, columns=VOICE_SESSION_COLUMNS)
+            self.flushed += len(rows)
+        except Exception as e:
+            # Put the batch back in front of anything buffered meanwhile and retry on the next flush
+            self.rows = rows + self.rows
+            overflow = len(self.rows) - VOICE_BUFFER_MAX_ROWS
+            if overflow > 0:
+                del self.rows[:overflow]
+                self.dropped += overflow
+            print(f"❌ Failed to write {len(rows)} voice sessions, keeping them buffered: {e}")
+
+voice_session_buffer = VoiceSessionBuffer()
+
+def open_voice_session(member, channel, joined_at=None):
+    open_voice_sessions.setdefault((member.guild.id, member.id), (channel.id, joined_at or discord.utils.utcnow()))
+
+def close_voice_session(guild_id, member_id, left_at=None):
+    session = open_voice_sessions.pop((guild_id, member_id), None)
+    if session is not None:
+        channel_id, joined_at = session
+        voice_session_buffer.add((guild_id, member_id, channel_id, joined_at, left_at or discord.utils.utcnow()))
+
+def record_voice_transition(member, before, after):
+    """Turn a voice state change into session boundaries; never waits on anything"""
+    if member.bot or before.channel == after.channel:
+        return
+    if is_monitored_voice_channel(before.channel):
+        close_voice_session(member.guild.id, member.id)
+    if is_monitored_voice_channel(after.channel):
+        open_voice_session(member, after.channel)
+
+def open_existing_voice_sessions():
+    """Sync sessions with who is in the monitored channels when the bot (re)connects"""
+    present = set()
+    for guild in bot.guilds:
+        config = get_guild_config(guild.id)
+        if not config:
+            continue
+        for channel_id in config['monitored_voice_channels']:
+            channel = guild.get_channel(channel_id)
+            for member in channel.members if channel else []:
+                if not member.bot:
+                    open_voice_session(member, channel)
+                    present.add((guild.id, member.id))
+
+    # Anyone who left while we were disconnected is closed as of now, the best we know
+    for guild_id, member_id in list(open_voice_sessions):
+        if (guild_id, member_id) not in present:
+            close_voice_session(guild_id, member_id)
+
+async def shutdown_voice_sessions():
+    """Close every open session and write the buffer out before the bot disconnects"""
+    left_at = discord.utils.utcnow()
+    for guild_id, member_id in list(open_voice_sessions):
+        close_voice_session(guild_id, member_id, left_at)
+    await voice_session_buffer.flush()
+    print(f"✅ Voice sessions flushed on shutdown ({voice_session_buffer.flushed} written this run)")
+
+@tasks.loop(seconds=VOICE_FLUSH_SECONDS)
+@prioritized('background')
+async def flush_voice_sessions():
+    await voice_session_buffer.flush()
+
+@bot.tree.command(name="voice_stats", description="Show SQB attendance and voice hours per member")
+@app_commands.describe(days="How many days back to report on")
+@deadline_guarded(thinking=True)
+async def voice_stats(interaction: discord.Interaction, days: app_commands.Range[int, 1, 90] = 14):
+    if interaction.guild is None or not get_guild_config(interaction.guild.id):
+        await interaction.followup.send("❌ This server isn't configured for SQB.", ephemeral=True)
+        return
+
+    # Include sessions that finished moments ago
+    await voice_session_buffer.flush()
+    since = discord.utils.utcnow() - timedelta(days=days)
+    try:
+        async with unit_of_work() as conn:
+            windows = await conn.fetch(VOICE_ATTENDANCE_SQL, interaction.guild.id, since, 10)
+            members = await conn.fetch(VOICE_HOURS_SQL, interaction.guild.id, since, 15)
+    except Exception as e:
+        print(f"❌ Database error in voice_stats: {e}")
+        await interaction.followup.send("❌ Could not load voice statistics, please try again.", ephemeral=True)
+        return
+
+    embed = discord.Embed(title=f"🎙️ SQB Voice Activity • last {days} days", color=0x009688)
+    attendance = [
+        f"`{row['sqb_date']:%a %d %b %H:%M}` BR {normalize_br(row['sqb_br'])} • "
+        f"**{row['members']}** members • {float(row['member_hours']):.1f}h"
+        for row in windows
+    ]
+    embed.add_field(name="📅 Attendance per SQB window", value="\n".join(attendance) or "No SQB windows in this period", inline=False)
+    hours = [
+        f"<@{row['member_id']}> **{float(row['hours']):.1f}h** over {row['sessions']} sessions"
+        for row in members
+    ]
+    embed.add_field(name="⏱️ Hours per member", value="\n".join(hours) or "No voice sessions recorded yet", inline=False)
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+# ──────────────── IN-PROCESS CACHES & CHANGE NOTIFICATIONS ────────────────
+
+CACHE_NOTIFY_CHANNEL = 'wtbot_cache'
+SCHEDULE_EMPTY_RECHECK_SECONDS = 300  # How long "no SQB scheduled" is cached when nothing is upcoming
+
+class CacheStore:
+    """Dict-backed cache whose entries are dropped when Postgres reports a change.
+
+    Dropped entries are kept aside as stale copies, served only to interactions
+    that are about to run out of time.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = {}
+        self.stale = {}
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every invalidation so a load that raced with a change isn't cached
+        self.version = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def get_stale(self, key):
+        value = self.entries.get(key)
+        return value if value is not None else self.stale.get(key)
+
+    def set(self, key, value, version=None):
+        """Store a value; pass the version read before loading it to drop results that raced a change"""
+        if version is not None and version != self.version:
+            return
+        self.entries[key] = value
+        self.stale.pop(key, None)
+
+    def invalidate(self, key):
+        self.version += 1
+        if key in self.entries:
+            self.stale[key] = self.entries.pop(key)
+
+    def clear(self):
+        self.version += 1
+        self.stale.update(self.entries)
+        self.entries.clear()
+
+schedule_cache = CacheStore('schedule')   # 'current' -> {'br', 'expires'}
+catalog_cache = CacheStore('catalog')     # BR -> vehicle rows for that BR
+loadout_cache = CacheStore('loadout')     # member ID -> {BR -> stored vehicle rows}
+cache_listener_conn = None
+
+# One trigger function serves every watched table; the payload carries just enough
+# (table, plus the BR / user / guild touched) for the bot to drop the affected entries.
+CACHE_TRIGGER_FUNCTION_DDL = f"""
+    CREATE OR REPLACE FUNCTION wtbot_notify_cache_change() RETURNS trigger AS $$
+    DECLARE
+        old_row JSONB := NULL;
+        new_row JSONB := NULL;
+        payload JSONB;
+    BEGIN
+        IF TG_LEVEL = 'ROW' AND TG_OP IN ('UPDATE', 'DELETE') THEN
+            old_row := to_jsonb(OLD);
+        END IF;
+        IF TG_LEVEL = 'ROW' AND TG_OP IN ('UPDATE', 'INSERT') THEN
+            new_row := to_jsonb(NEW);
+        END IF;
+
+        payload := jsonb_build_object('table', TG_TABLE_NAME, 'op', TG_OP);
+        IF TG_TABLE_NAME = 'vehicle_table' THEN
+            payload := payload || jsonb_build_object('keys', jsonb_build_array(old_row->>'vehicle_br', new_row->>'vehicle_br'));
+        ELSIF TG_TABLE_NAME = 'discord_data_gathered' THEN
+            payload := payload || jsonb_build_object('keys', jsonb_build_array(old_row->>'discord_id', new_row->>'discord_id'));
+        END IF;
+
+        PERFORM pg_notify('{CACHE_NOTIFY_CHANNEL}', payload::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# One counter per watched table, bumped once per modifying statement. Comparing them is a cheap
+# way to tell whether anything changed between two points in time (see the warm-start snapshot).
+CACHE_VERSIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS wtbot_cache_versions (
+        table_name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL
+    )
+"""
+
+CACHE_VERSION_FUNCTION_DDL = """
+    CREATE OR REPLACE FUNCTION wtbot_bump_cache_version() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO wtbot_cache_versions (table_name, version) VALUES (TG_TABLE_NAME, 1)
+        ON CONFLICT (table_name) DO UPDATE SET version = wtbot_cache_versions.version + 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+CACHE_VERSIONS_SQL = """
+    SELECT table_name, version FROM wtbot_cache_versions
+"""
+
+CACHE_WATCHED_TABLES = ['vehicle_table', 'nations', 'sqb_schedule', 'discord_data_gathered', 'guild_config', 'guild_squadrons']
+# Rewritten in bulk by the squadron refresh; one notification per statement is enough to rebuild the name index
+CACHE_STATEMENT_WATCHED_TABLES = ['squadron_cache']
+
+async def install_cache_triggers():
+    """Create the NOTIFY triggers on every table the bot caches data from"""
+    if db_pool is None:
+        return
+
+    try:
+        async with unit_of_work() as conn:
+            async with conn.transaction():
+                await conn.execute(CACHE_TRIGGER_FUNCTION_DDL)
+                for table in CACHE_WATCHED_TABLES:
+                    await conn.execute(f"DROP TRIGGER IF EXISTS wtbot_cache_notify ON {table}")
+                    await conn.execute(f"""
+                        CREATE TRIGGER wtbot_cache_notify
+                        AFTER INSERT OR UPDATE OR DELETE ON {table}
+                        FOR EACH ROW EXECUTE FUNCTION wtbot_notify_cache_change()
+                    """)
+                    await conn.execute(f"DROP TRIGGER IF EXISTS wtbot_cache_notify_truncate ON {table}")
+                    await conn.execute(f"""
+                        CREATE TRIGGER wtbot_cache_notify_truncate
+                        AFTER TRUNCATE ON {table}
+                        FOR EACH STATEMENT EXECUTE FUNCTION wtbot_notify_cache_change()
+                    """)
+                for table in CACHE_STATEMENT_WATCHED_TABLES:
+                    await conn.execute(f"DROP TRIGGER IF EXISTS wtbot_cache_notify_statement ON {table}")
+                    await conn.execute(f"""
+                        CREATE TRIGGER wtbot_cache_notify_statement
+                        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                        FOR EACH STATEMENT EXECUTE FUNCTION wtbot_notify_cache_change()
+                    """)
+                await conn.execute(CACHE_VERSIONS_DDL)
+                await conn.execute(CACHE_VERSION_FUNCTION_DDL)
+                for table in CACHE_WATCHED_TABLES + CACHE_STATEMENT_WATCHED_TABLES:
+                    await conn.execute(f"DROP TRIGGER IF EXISTS wtbot_cache_version ON {table}")
+                    await conn.execute(f"""
+                        CREATE TRIGGER wtbot_cache_version
+                        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                        FOR EACH STATEMENT EXECUTE FUNCTION wtbot_bump_cache_version()
+                    """)
+        print(f"✅ Cache invalidation triggers installed on {', '.join(CACHE_WATCHED_TABLES + CACHE_STATEMENT_WATCHED_TABLES)}")
+    except Exception as e:
+        print(f"❌ Failed to install cache invalidation triggers: {e}")
+
+def clear_all_caches():
+    schedule_cache.clear()
+    catalog_cache.clear()
+    loadout_cache.clear()
+
+def on_cache_notification(connection, pid, channel, payload):
+    """Drop the cache entries a table change affects (called by asyncpg on NOTIFY)"""
+    try:
+        change = json.loads(payload)
+    except ValueError:
+        print(f"❌ Ignoring malformed cache notification: {payload}")
+        return
+
+    table = change.get('table')
+    keys = [key for key in change.get('keys') or [] if key is not None]
+
+    if table == 'vehicle_table':
+        if keys:
+            for br in keys:
+                catalog_cache.invalidate(normalize_br(br))
+        else:
+            catalog_cache.clear()
+        # Loadouts embed vehicle names and types, so any catalog edit can change them
+        loadout_cache.clear()
+        schedule_vehicle_index_refresh()
+    elif table == 'nations':
+        catalog_cache.clear()
+        loadout_cache.clear()
+        schedule_vehicle_index_refresh()
+    elif table == 'sqb_schedule':
+        schedule_cache.clear()
+    elif table == 'discord_data_gathered':
+        if keys:
+            for member_id in keys:
+                loadout_cache.invalidate(int(member_id))
+        else:
+            loadout_cache.clear()
+    elif table in ('guild_config', 'guild_squadrons'):
+        asyncio.get_running_loop().create_task(reload_guild_configs())
+    elif table == 'squadron_cache':
+        spawn_background(refresh_player_name_index)
+
+@tasks.loop(seconds=30)
+async def maintain_cache_listener():
+    """Keep the dedicated LISTEN connection open, reconnecting if it drops"""
+    global cache_listener_conn, warm_start_versions
+    if cache_listener_conn is not None and not cache_listener_conn.is_closed():
+        return
+
+    try:
+        cache_listener_conn = await asyncpg.connect(
+            host=DB_HOST,
+            port=DB_PORT,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            database=DB_NAME
+        )
+        await cache_listener_conn.add_listener(CACHE_NOTIFY_CHANNEL, on_cache_notification)
+        await cache_listener_conn.add_listener(SCRAPE_REQUEST_CHANNEL, on_scrape_request)
+    except Exception as e:
+        cache_listener_conn = None
+        print(f"❌ Failed to open cache listener connection: {e}")
+        return
+
+    if warm_start_versions is not None:
+        # Caches came from a snapshot; drop only what changed since it was taken
+        try:
+            versions = await fetch_cache_versions(cache_listener_conn)
+        except Exception as e:
+            print(f"❌ Failed to read cache versions: {e}")
+            versions = {}
+        changed = {table for table in set(versions) | set(warm_start_versions) if versions.get(table) != warm_start_versions.get(table)}
+        warm_start_versions = None
+        for table in changed:
+            on_cache_notification(cache_listener_conn, None, CACHE_NOTIFY_CHANNEL, json.dumps({'table': table}))
+    else:
+        # Anything could have changed while we weren't listening
+        clear_all_caches()
+        if player_name_index.loaded:
+            spawn_background(refresh_player_name_index)
+        if vehicle_search_index.loaded:
+            schedule_vehicle_index_refresh()
+    if not write_warm_snapshot.is_running():
+        write_warm_snapshot.start()
+    print(f"✅ Listening for cache invalidations on '{CACHE_NOTIFY_CHANNEL}'")
+
+# ──────────────── WARM-START SNAPSHOT ────────────────
+
+WARM_SNAPSHOT_PATH = os.getenv("WARM_SNAPSHOT_PATH", "wtbot_snapshot.json")
+WARM_SNAPSHOT_FORMAT = 1
+WARM_SNAPSHOT_INTERVAL_MINUTES = 5
+WARM_SNAPSHOT_MAX_AGE_SECONDS = 6 * 3600  # Older snapshots aren't worth validating
+
+# Snapshot sections and the tables whose version must be unchanged for each to be trusted
+WARM_SNAPSHOT_SECTIONS = {
+    'schedule': ['sqb_schedule'],
+    'catalog': ['vehicle_table', 'nations'],
+    'vehicles': ['vehicle_table', 'nations'],
+    'squadron_players': ['squadron_cache'],
+}
+
+warm_start_versions = None  # Table versions the snapshot-loaded caches reflect, until the listener takes over
+
+async def fetch_cache_versions(conn):
+    return {row['table_name']: row['version'] for row in await conn.fetch(CACHE_VERSIONS_SQL)}
+
+def collect_warm_snapshot(versions):
+    """Copy the warm-startable state into plain JSON-able structures (on the event loop, no awaits)"""
+    schedule = schedule_cache.entries.get('current')
+    squadron_players = [
+        {'player_name': stats['player_name'], 'squadron_name': squadron, 'points': stats['points'], 'activity': stats['activity']}
+        for squadron, players in player_name_index.players.items()
+        for stats in players.values()
+    ]
+    return {
+        'format': WARM_SNAPSHOT_FORMAT,
+        'written_at': time.time(),
+        'versions': versions,
+        'schedule': {
+            'br': schedule['br'],
+            'expires_at': time.time() + schedule['expires'] - time.monotonic()
+        } if schedule is not None else None,
+        'catalog': dict(catalog_cache.entries),
+        'vehicles': list(vehicle_search_index.vehicles) if vehicle_search_index.loaded else None,
+        'squadron_players': squadron_players if player_name_index.loaded else None,
+        'user_messages': [[guild_id, member_id, message_id] for (guild_id, member_id), message_id in user_messages.items()],
+    }
+
+def write_snapshot_file(snapshot, path):
+    """Write the snapshot atomically: a crash mid-write leaves the previous file intact"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def read_snapshot_file(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+@tasks.loop(minutes=WARM_SNAPSHOT_INTERVAL_MINUTES)
+@prioritized('background')
+async def write_warm_snapshot():
+    """Periodically persist the caches so the next start is served warm"""
+    if cache_listener_conn is None or cache_listener_conn.is_closed():
+        return  # Without the listener we can't tell which versions the caches reflect
+
+    try:
+        # Read versions on the LISTEN connection and let pending notification callbacks run:
+        # every change up to these versions has then been applied to the caches
+        versions = await fetch_cache_versions(cache_listener_conn)
+        await asyncio.sleep(0)
+        snapshot = collect_warm_snapshot(versions)
+        await run_in_thread(write_snapshot_file, snapshot, WARM_SNAPSHOT_PATH)
+    except Exception as e:
+        print(f"❌ Failed to write warm-start snapshot: {e}")
+
+async def load_warm_snapshot():
+    """Fill the caches from the last snapshot before the gateway connects, section by section"""
+    global warm_start_versions
+    try:
+        snapshot = await run_in_thread(read_snapshot_file, WARM_SNAPSHOT_PATH)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Ignoring unreadable warm-start snapshot: {e}")
+        return
+
+    age = time.time() - snapshot.get('written_at', 0)
+    if snapshot.get('format') != WARM_SNAPSHOT_FORMAT or age > WARM_SNAPSHOT_MAX_AGE_SECONDS:
+        print("⚠️ Ignoring warm-start snapshot (old format or too old)")
+        return
+
+    try:
+        conn = await asyncpg.connect(host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, database=DB_NAME)
+        try:
+            versions = await fetch_cache_versions(conn)
+        finally:
+            await conn.close()
+    except Exception as e:
+        print(f"⚠️ Skipping warm start, could not check cache versions: {e}")
+        return
+
+    snapshot_versions = snapshot.get('versions', {})
+    valid = {
+        section for section, tables in WARM_SNAPSHOT_SECTIONS.items()
+        if snapshot.get(section) is not None and all(snapshot_versions.get(t) == versions.get(t) for t in tables)
+    }
+
+    if 'schedule' in valid:
+        seconds_left = snapshot['schedule']['expires_at'] - time.time()
+        if seconds_left > 0:
+            schedule_cache.set('current', {'br': snapshot['schedule']['br'], 'expires': time.monotonic() + seconds_left})
+    if 'catalog' in valid:
+        for br, vehicles in snapshot['catalog'].items():
+            catalog_cache.set(br, vehicles)
+    if 'vehicles' in valid:
+        await run_in_thread(vehicle_search_index.build, snapshot['vehicles'])
+    if 'squadron_players' in valid:
+        player_name_index.build(snapshot['squadron_players'])
+    # Messages aren't in the database; a stale ID just hits NotFound when it's deleted
+    for guild_id, member_id, message_id in snapshot.get('user_messages', []):
+        user_messages.setdefault((guild_id, member_id), message_id)
+
+    warm_start_versions = snapshot_versions
+    print(f"✅ Warm start from snapshot ({age:.0f}s old): loaded {', '.join(sorted(valid)) or 'no cache sections'}, "
+          f"{len(snapshot.get('user_messages', []))} tracked messages")
+
 # ──────────────── HELPER FUNCTIONS ────────────────
 
+def normalize_br(value):
+    """Format a battle rating for display and cache keys ("8.0" -> "8", "10.0" -> "10", "8.30" -> "8.3")"""
+    br = str(value)
+    if '.' in br:
+        br = br.rstrip('0').rstrip('.')
+    return br
+
+def br_param(br):
+    """Convert a BR string into the NUMERIC query parameter vehicle_br is compared against"""
+    return decimal.Decimal(br)
+
 async def get_current_battle_rating():
+    cached = schedule_cache.get('current')
+    if cached is not None and cached['expires'] > time.monotonic():
+        return cached['br']
+
+    # An expired or invalidated BR is still right almost always; prefer it to a late answer
+    stale = serve_stale(schedule_cache, 'current')
+    if stale is not None:
+        return stale['br']
+
     if db_pool is None:
         print("❌ Database connection not available")
         return None
     
+    version = schedule_cache.version
     try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT sqb_br FROM sqb_schedule
-                WHERE NOW() BETWEEN sqb_date AND end_date
-                LIMIT 1
-            """)
+        async with unit_of_work(timeout=budget_acquire_timeout()) as conn:
+            row = await conn.fetchrow(CURRENT_BR_SQL)
             if row:
-                br = str(row['sqb_br'])
-                return br.rstrip('.0') if br.endswith('.0') else br
-            return None
+                br = normalize_br(row['sqb_br'])
+                seconds_left = float(row['seconds_left'])
+            else:
+                # No SQB window right now, remember that until the next one starts
+                br = None
+                seconds_left = await conn.fetchval(NEXT_SQB_START_SQL)
+                seconds_left = float(seconds_left) if seconds_left is not None else SCHEDULE_EMPTY_RECHECK_SECONDS
+            schedule_cache.set('current', {'br': br, 'expires': time.monotonic() + max(seconds_left, 0)}, version)
+            return br
     except Exception as e:
         print(f"❌ Database error in get_current_battle_rating: {e}")
-        return None
+        stale = schedule_cache.get_stale('current')
+        return stale['br'] if stale is not None else None
 
 async def get_all_vehicles_for_br(br):
+    cached = catalog_cache.get(br)
+    if cached is not None:
+        return cached
+
+    stale = serve_stale(catalog_cache, br)
+    if stale is not None:
+        return stale
+
     if db_pool is None:
         print("❌ Database connection not available")
         return []
     
+    version = catalog_cache.version
     try:
-        async with db_pool.acquire() as conn:
-            return await conn.fetch("""
-                SELECT vt.vehicle_id, vt.vehicle_name, vt.vehicle_type, n.nation_name, n.nation_id
-                FROM vehicle_table vt
-                JOIN nations n ON vt.nation_id = n.nation_id
-                WHERE TRIM(TRAILING '.0' FROM vt.vehicle_br::TEXT) = $1
-                ORDER BY 
-                    CASE WHEN n.nation_id = 11 THEN 1 ELSE 0 END,
-                    n.nation_id,
-                    vt.vehicle_name
-            """, br)
+        async with unit_of_work(timeout=budget_acquire_timeout()) as conn:
+            rows = await conn.fetch(CATALOG_FOR_BR_SQL, br_param(br))
     except Exception as e:
         print(f"❌ Database error in get_all_vehicles_for_br: {e}")
-        return []
+        return catalog_cache.get_stale(br) or []
+
+    vehicles = [dict(row) for row in rows]
+    catalog_cache.set(br, vehicles, version)
+    return vehicles
+
+def is_placeholder_vehicle(vehicle_name):
+    """Placeholder catalog rows ("No vehicle", "N/A") are selectable but never shown in posts"""
+    name = vehicle_name.lower()
+    return 'no vehicle' in name or 'n/a' in name
+
+async def get_user_loadout(user_id, br):
+    """Get every vehicle a user has stored for a BR, including placeholder rows"""
+    user_loadouts = loadout_cache.get(user_id)
+    if user_loadouts is not None and br in user_loadouts:
+        return user_loadouts[br]
+
+    stale = serve_stale(loadout_cache, user_id)
+    if stale is not None and br in stale:
+        return stale[br]
 
-async def get_user_vehicle_ids(user_id, br):
     if db_pool is None:
         print("❌ Database connection not available")
-        return set()
-    
+        return []
+
+    version = loadout_cache.version
     try:
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT vt.vehicle_id
-                FROM discord_data_gathered dg
-                JOIN vehicle_table vt ON dg.vehicle_id = vt.vehicle_id
-                WHERE dg.user_id = $1 AND TRIM(TRAILING '.0' FROM vt.vehicle_br::TEXT) = $2
-            """, user_id, br)
-            return {row['vehicle_id'] for row in rows}
+        async with unit_of_work(timeout=budget_acquire_timeout()) as conn:
+            rows = await conn.fetch(USER_LOADOUT_SQL, user_id, br_param(br))
     except Exception as e:
-        print(f"❌ Database error in get_user_vehicle_ids: {e}")
-        return set()
+        print(f"❌ Database error in get_user_loadout: {e}")
+        stale = loadout_cache.get_stale(user_id)
+        return stale.get(br, []) if stale is not None else []
+
+    loadout = [dict(row) for row in rows]
+    if version == loadout_cache.version:
+        user_loadouts = loadout_cache.entries.setdefault(user_id, {})
+        user_loadouts[br] = loadout
+    return loadout
+
+async def get_user_vehicles_for_post(user_id, br):
+    """Get the vehicles shown in a user's voice channel post (placeholders filtered out)"""
+    return [v for v in await get_user_loadout(user_id, br) if not is_placeholder_vehicle(v['vehicle_name'])]
+
+async def get_user_vehicle_ids(user_id, br):
+    return {v['vehicle_id'] for v in await get_user_loadout(user_id, br)}
 
 async def store_user_vehicle(user_id, vehicle_id, warthunder_user):
-    if db_pool is None:
-        print("❌ Database connection not available")
+    """Add a vehicle to a user's list; returns False if they already had it.
+
+    Raises one of DATABASE_ERRORS when the database is unavailable or the write fails.
+    """
+    async with unit_of_work() as conn:
+        if await conn.fetchval(USER_VEHICLE_EXISTS_SQL, user_id, vehicle_id):
+            return False
+        await conn.execute(INSERT_USER_VEHICLE_SQL, user_id, vehicle_id, warthunder_user)
+    # Invalidate locally straight away rather than waiting for our own NOTIFY to come back
+    loadout_cache.invalidate(user_id)
+    print(f"Debug: Stored vehicle {vehicle_id} for user {user_id}")
+    return True
+
+# ──────────────── USER IDENTITY MIGRATION ────────────────
+
+unadopted_user_keys = set()  # Old "name#discriminator" keys that still have rows without a discord_id
+
+def legacy_user_key(member):
+    """The text key vehicles were stored under before rows were keyed by member ID"""
+    return f"{member.name}#{member.discriminator}"
+
+async def load_unadopted_user_keys():
+    try:
+        async with unit_of_work() as conn:
+            rows = await conn.fetch(UNADOPTED_USER_KEYS_SQL)
+    except Exception as e:
+        print(f"❌ Failed to load unadopted user keys: {e}")
         return
-    
+    unadopted_user_keys.clear()
+    unadopted_user_keys.update(row['user_id'] for row in rows if row['user_id'] is not None)
+    if unadopted_user_keys:
+        print(f"🔍 {len(unadopted_user_keys)} user(s) still have vehicles stored under their old name key")
+
+async def adopt_legacy_rows(members):
+    """Key any rows stored under these members' old name keys by their member ID (a set lookup once done)"""
+    pending = {legacy_user_key(m): m.id for m in members if legacy_user_key(m) in unadopted_user_keys}
+    if not pending or db_pool is None:
+        return
+
     try:
-        async with db_pool.acquire() as conn:
-            exists = await conn.fetchval("""
-                SELECT 1 FROM discord_data_gathered
-                WHERE user_id = $1 AND vehicle_id = $2
-            """, user_id, vehicle_id)
-            if not exists:
-                await conn.execute("""
-                    INSERT INTO discord_data_gathered (user_id, vehicle_id, warthunder_user)
-                    VALUES ($1, $2, $3)
-                """, user_id, vehicle_id, warthunder_user)
-                print(f"Debug: Stored vehicle {vehicle_id} for user {user_id}")
+        async with unit_of_work() as conn:
+            await conn.execute(ADOPT_LEGACY_ROWS_SQL, list(pending), list(pending.values()))
     except Exception as e:
-        print(f"❌ Database error in store_user_vehicle: {e}")
+        print(f"❌ Failed to adopt stored vehicles for {len(pending)} member(s): {e}")
+        return
+    unadopted_user_keys.difference_update(pending)
+    for member_id in pending.values():
+        loadout_cache.invalidate(member_id)
+    print(f"✅ Adopted stored vehicles for {len(pending)} member(s) by Discord ID")
+
+async def list_guild_members(guild, role_ids=None):
+    """A guild's members, or only those holding one of role_ids.
+
+    Served from the member cache once the guild is chunked. Lean mode only caches
+    members in voice, so there the member list is paged from the API instead.
+    """
+    if guild.chunked:
+        if role_ids is None:
+            return list(guild.members)
+        roles = [guild.get_role(role_id) for role_id in role_ids]
+        return list({member for role in roles if role for member in role.members})
+    members = [member async for member in guild.fetch_members(limit=None)]
+    if role_ids is None:
+        return members
+    return [member for member in members if any(role.id in role_ids for role in member.roles)]
+
+@leader_only
+async def backfill_discord_ids():
+    """Adopt the legacy rows of every member of the configured guilds, on the leader once it is elected"""
+    for guild_id in list(guild_configs):
+        guild = bot.get_guild(guild_id)
+        if guild is None or not unadopted_user_keys:
+            continue
+        try:
+            members = await list_guild_members(guild)
+        except discord.DiscordException as e:
+            print(f"❌ Could not list members of guild {guild_id} for the ID backfill: {e}")
+            continue
+        await adopt_legacy_rows(members)
+
+    if unadopted_user_keys:
+        print(f"⚠️ {len(unadopted_user_keys)} old user key(s) match no current member; they'll be adopted if that member is seen again")
 
 # ──────────────── HELPER FUNCTION FOR POSTING USER VEHICLES ────────────────
 
 async def post_user_vehicles_and_cleanup(member, user_id, warthunder_user, br):
     """Post user's vehicles to the monitored channel and clean up old messages"""
-    channel = bot.get_channel(TEXT_CHANNEL_ID)
+    channel = get_text_channel(member.guild)
     if not channel:
         return
     
     # Delete any existing message for this user
-    if member.id in user_messages:
+    message_key = (member.guild.id, member.id)
+    if message_key in user_messages:
         try:
-            old_message = await channel.fetch_message(user_messages[member.id])
+            old_message = await channel.fetch_message(user_messages[message_key])
             await old_message.delete()
             print(f"Debug: Deleted old message for {member.name} after /sqb_queue completion")
         except discord.NotFound:
@@ -781,25 +2553,7 @@ async def post_user_vehicles_and_cleanup(member, user_id, warthunder_user, br):
     if db_pool is None:
         return
     
-    try:
-        async with db_pool.acquire() as conn:
-            vehicles = await conn.fetch("""
-                SELECT vt.vehicle_name, vt.vehicle_type, n.nation_name
-                FROM discord_data_gathered dg
-                JOIN vehicle_table vt ON vt.vehicle_id = dg.vehicle_id
-                JOIN nations n ON vt.nation_id = n.nation_id
-                WHERE dg.user_id = $1 AND TRIM(TRAILING '.0' FROM vt.vehicle_br::TEXT) = $2
-                AND vt.vehicle_name NOT ILIKE '%no vehicle%'
-                AND vt.vehicle_name NOT ILIKE '%n/a%'
-                ORDER BY 
-                    CASE WHEN n.nation_id = 11 THEN 1 ELSE 0 END,
-                    n.nation_id,
-                    vt.vehicle_type,
-                    vt.vehicle_name
-            """, user_id, br)
-    except Exception as e:
-        print(f"❌ Database error in post_user_vehicles_and_cleanup: {e}")
-        return
+    vehicles = await get_user_vehicles_for_post(user_id, br)
 
     # Get squadron data for the user
     squadron_data = await get_squadron_data_for_user(member, warthunder_user)
@@ -825,7 +2579,7 @@ async def post_user_vehicles_and_cleanup(member, user_id, warthunder_user, br):
             )
         
         message = await channel.send(embed=embed)
-        user_messages[member.id] = message.id
+        user_messages[message_key] = message.id
     else:
         # Group vehicles by type for better organization
         vehicles_by_type = {}
@@ -882,7 +2636,1237 @@ async def post_user_vehicles_and_cleanup(member, user_id, warthunder_user, br):
         embed.set_footer(text=f"Total vehicles: {total_vehicles}")
         
         message = await channel.send(embed=embed)
-        user_messages[member.id] = message.id
+        user_messages[message_key] = message.id
+
+# ──────────────── SQB ROSTER ────────────────
+
+ROSTER_CATEGORY_LABELS = {'ground': 'Ground', 'spaa': 'SPAA', 'air': 'Aircraft', 'heli': 'Helicopters'}
+
+async def get_roster_members(guild, squadron_name=None):
+    """Members to include in a roster: everyone in the monitored voice channels, or a squadron's role holders"""
+    config = get_guild_config(guild.id)
+    if not config:
+        return []
+
+    members = {}
+    if squadron_name:
+        role_ids = {role.id for role in guild.roles if config['role_squadron_mapping'].get(role.name) == squadron_name}
+        for member in await list_guild_members(guild, role_ids):
+            members[member.id] = member
+    else:
+        for channel_id in config['monitored_voice_channels']:
+            channel = guild.get_channel(channel_id)
+            if channel:
+                for member in channel.members:
+                    members[member.id] = member
+    return [member for member in members.values() if not member.bot]
+
+async def get_roster_matrix(user_ids, br):
+    """Every vehicle at a BR owned by any of the given users, with its owners, in one query"""
+    async with unit_of_work() as conn:
+        rows = await conn.fetch(ROSTER_MATRIX_SQL, br_param(br), list(user_ids))
+    return [dict(row) for row in rows if not is_placeholder_vehicle(row['vehicle_name'])]
+
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def csv_safe(value):
+    """Quote a text cell spreadsheets would run as a formula (names are user-controlled)"""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def build_roster_csv(members, vehicles):
+    """Render the member x vehicle matrix as CSV text (runs in a worker thread).
+
+    members is a list of (member_id, discord_name, warthunder_name) tuples and
+    vehicles the rows from get_roster_matrix().
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(
+        ['Discord', 'War Thunder', 'Vehicles'] +
+        [csv_safe(f"{v['vehicle_name']} ({v['nation_name']}) [{ROSTER_CATEGORY_LABELS[categorize_vehicle_type(v['vehicle_type'])]}]") for v in vehicles]
+    )
+
+    owner_sets = [set(v['owners']) for v in vehicles]
+    for user_id, discord_name, warthunder_name in members:
+        owned = ['x' if user_id in owners else '' for owners in owner_sets]
+        writer.writerow([csv_safe(discord_name), csv_safe(warthunder_name), owned.count('x')] + owned)
+    return output.getvalue()
+
+@bot.tree.command(name="sqb_roster", description="Export who owns which vehicles at the current battle rating")
+@app_commands.describe(squadron="Squadron to include instead of the members in SQB voice channels")
+@deadline_guarded(thinking=True)
+async def sqb_roster(interaction: discord.Interaction, squadron: str = None):
+    if interaction.guild is None or not get_guild_config(interaction.guild.id):
+        await interaction.followup.send("❌ This server isn't configured for SQB.", ephemeral=True)
+        return
+
+    br = await get_current_battle_rating()
+    if not br:
+        await interaction.followup.send("❌ Could not determine current battle rating.", ephemeral=True)
+        return
+
+    members = await get_roster_members(interaction.guild, squadron)
+    if not members:
+        where = f"squadron **{squadron}**" if squadron else "the SQB voice channels"
+        await interaction.followup.send(f"❌ No members found in {where}.", ephemeral=True)
+        return
+
+    await adopt_legacy_rows(members)
+    roster = sorted(
+        ((m.id, m.display_name, get_warthunder_name(m)) for m in members),
+        key=lambda entry: entry[2].lower()
+    )
+    try:
+        vehicles = await get_roster_matrix([user_id for user_id, _, _ in roster], br)
+    except Exception as e:
+        print(f"❌ Database error in sqb_roster: {e}")
+        await interaction.followup.send("❌ Could not load the roster, please try again.", ephemeral=True)
+        return
+
+    csv_text = await run_in_thread(build_roster_csv, roster, vehicles)
+
+    # Summary: how many members can field each category
+    owners_by_category = {category: set() for category in ROSTER_CATEGORY_LABELS}
+    vehicles_by_category = {category: 0 for category in ROSTER_CATEGORY_LABELS}
+    for v in vehicles:
+        category = categorize_vehicle_type(v['vehicle_type'])
+        owners_by_category[category].update(v['owners'])
+        vehicles_by_category[category] += 1
+    members_with_vehicles = set().union(*owners_by_category.values())
+    missing = [warthunder_name for user_id, _, warthunder_name in roster if user_id not in members_with_vehicles]
+
+    embed = discord.Embed(
+        title=f"📋 SQB Roster • BR {br}",
+        description=f"**{len(roster)}** members from {f'**{squadron}**' if squadron else 'SQB voice channels'}, "
+                    f"**{len(members_with_vehicles)}** with vehicles set",
+        color=0x3F51B5
+    )
+    for category, label in ROSTER_CATEGORY_LABELS.items():
+        embed.add_field(
+            name=label,
+            value=f"{len(owners_by_category[category])} players • {vehicles_by_category[category]} vehicles",
+            inline=True
+        )
+    if missing:
+        missing_list = ", ".join(missing[:20]) + (f" and {len(missing) - 20} more" if len(missing) > 20 else "")
+        embed.add_field(name=f"⚠️ No vehicles set ({len(missing)})", value=missing_list, inline=False)
+    embed.set_footer(text="Full member × vehicle matrix attached as CSV")
+
+    file = discord.File(io.BytesIO(csv_text.encode('utf-8')), filename=f"sqb_roster_br{br}.csv")
+    await interaction.followup.send(embed=embed, file=file, ephemeral=True)
+
+# ──────────────── SQB LINEUP OPTIMIZER ────────────────
+
+LINEUP_SIZE = 8
+LINEUP_PREFERRED_NATION_BONUS = 10.0  # Worth more than any flexibility tiebreak
+LINEUP_FLEXIBILITY_WEIGHT = 0.1       # Small nudge towards players with more options in a slot's category
+LINEUP_INFEASIBLE_COST = 1e9          # Cost of a slot a player has no vehicle for
+
+def popcount(mask):
+    return bin(mask).count("1")
+
+def lowest_bit_index(mask):
+    return (mask & -mask).bit_length() - 1
+
+def solve_assignment(cost):
+    """Minimum-cost assignment of every row to a distinct column (Hungarian algorithm).
+
+    cost is a rows x columns matrix with rows <= columns. Returns the column
+    assigned to each row. O(rows² x columns), so a full 8-slot lineup over
+    a few hundred candidates stays in the low milliseconds.
+    """
+    rows, columns = len(cost), len(cost[0])
+    infinity = float('inf')
+    u = [0.0] * (rows + 1)
+    v = [0.0] * (columns + 1)
+    owner = [0] * (columns + 1)  # owner[j] = row currently assigned to column j (1-based, 0 = free)
+    way = [0] * (columns + 1)
+
+    for row in range(1, rows + 1):
+        owner[0] = row
+        j0 = 0
+        min_slack = [infinity] * (columns + 1)
+        used = [False] * (columns + 1)
+        while True:
+            used[j0] = True
+            i0 = owner[j0]
+            cost_row = cost[i0 - 1]
+            delta = infinity
+            j1 = 0
+            for j in range(1, columns + 1):
+                if not used[j]:
+                    slack = cost_row[j - 1] - u[i0] - v[j]
+                    if slack < min_slack[j]:
+                        min_slack[j] = slack
+                        way[j] = j0
+                    if min_slack[j] < delta:
+                        delta = min_slack[j]
+                        j1 = j
+            for j in range(columns + 1):
+                if used[j]:
+                    u[owner[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_slack[j] -= delta
+            j0 = j1
+            if owner[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+
+    assignment = [-1] * rows
+    for j in range(1, columns + 1):
+        if owner[j]:
+            assignment[owner[j] - 1] = j - 1
+    return assignment
+
+def solve_lineup(ownership, category_masks, preferred_mask, slot_counts):
+    """Pick one player and one vehicle per lineup slot.
+
+    ownership is one vehicle bitmask per candidate, category_masks maps a
+    category to the bitmask of its vehicles, preferred_mask marks vehicles
+    from preferred nations and slot_counts maps a category to how many slots
+    it needs. Returns (picks, unfilled) where picks is a list of
+    (category, candidate index, vehicle bit) and unfilled counts slots per
+    category nobody could fill.
+    """
+    slots = [category for category, count in slot_counts.items() for _ in range(count)]
+    if not slots:
+        return [], {}
+
+    # One cost row per slot, computed once per (category, candidate)
+    costs_by_category = {}
+    for category in slot_counts:
+        category_mask = category_masks.get(category, 0)
+        row = []
+        for owned in ownership:
+            owned_in_category = owned & category_mask
+            if not owned_in_category:
+                row.append(LINEUP_INFEASIBLE_COST)
+                continue
+            score = 1.0 + LINEUP_FLEXIBILITY_WEIGHT * min(popcount(owned_in_category), 5)
+            if owned_in_category & preferred_mask:
+                score += LINEUP_PREFERRED_NATION_BONUS
+            row.append(-score)
+        # Pad with dummy candidates so there is always a column for every slot
+        row.extend([LINEUP_INFEASIBLE_COST] * max(0, len(slots) - len(ownership)))
+        costs_by_category[category] = row
+
+    assignment = solve_assignment([costs_by_category[category] for category in slots])
+
+    picks = []
+    unfilled = {}
+    for category, candidate in zip(slots, assignment):
+        if candidate >= len(ownership) or costs_by_category[category][candidate] >= LINEUP_INFEASIBLE_COST:
+            unfilled[category] = unfilled.get(category, 0) + 1
+            continue
+        owned_in_category = ownership[candidate] & category_masks[category]
+        choices = owned_in_category & preferred_mask or owned_in_category
+        picks.append((category, candidate, lowest_bit_index(choices)))
+    return picks, unfilled
+
+def encode_lineup_candidates(user_ids, vehicles, preferred_nations):
+    """Bitset-encode vehicle ownership from get_roster_matrix() rows (bit i = vehicles[i])"""
+    index_by_user = {user_id: i for i, user_id in enumerate(user_ids)}
+    ownership = [0] * len(user_ids)
+    category_masks = {}
+    preferred_mask = 0
+    for bit, v in enumerate(vehicles):
+        vehicle_bit = 1 << bit
+        category = categorize_vehicle_type(v['vehicle_type'])
+        category_masks[category] = category_masks.get(category, 0) | vehicle_bit
+        if v['nation_name'].lower() in preferred_nations:
+            preferred_mask |= vehicle_bit
+        for owner in v['owners']:
+            if owner in index_by_user:
+                ownership[index_by_user[owner]] |= vehicle_bit
+    return ownership, category_masks, preferred_mask
+
+@bot.tree.command(name="sqb_lineup", description="Suggest an SQB lineup from the members in voice chat")
+@app_commands.describe(
+    ground="Number of ground vehicle slots",
+    air="Number of aircraft slots",
+    spaa="Number of SPAA slots",
+    heli="Number of helicopter slots",
+    nations="Preferred nations, comma separated"
+)
+@deadline_guarded(thinking=True)
+async def sqb_lineup(
+    interaction: discord.Interaction,
+    ground: app_commands.Range[int, 0, LINEUP_SIZE] = 5,
+    air: app_commands.Range[int, 0, LINEUP_SIZE] = 2,
+    spaa: app_commands.Range[int, 0, LINEUP_SIZE] = 1,
+    heli: app_commands.Range[int, 0, LINEUP_SIZE] = 0,
+    nations: str = None
+):
+    slot_counts = {'ground': ground, 'air': air, 'spaa': spaa, 'heli': heli}
+    total_slots = sum(slot_counts.values())
+    if not 1 <= total_slots <= LINEUP_SIZE:
+        await interaction.followup.send(f"❌ A lineup needs between 1 and {LINEUP_SIZE} slots, got {total_slots}.", ephemeral=True)
+        return
+
+    if interaction.guild is None or not get_guild_config(interaction.guild.id):
+        await interaction.followup.send("❌ This server isn't configured for SQB.", ephemeral=True)
+        return
+
+    br = await get_current_battle_rating()
+    if not br:
+        await interaction.followup.send("❌ Could not determine current battle rating.", ephemeral=True)
+        return
+
+    members = sorted(await get_roster_members(interaction.guild), key=lambda m: m.id)
+    if not members:
+        await interaction.followup.send("❌ Nobody is in the SQB voice channels.", ephemeral=True)
+        return
+
+    await adopt_legacy_rows(members)
+    user_ids = [m.id for m in members]
+    try:
+        vehicles = await get_roster_matrix(user_ids, br)
+    except Exception as e:
+        print(f"❌ Database error in sqb_lineup: {e}")
+        await interaction.followup.send("❌ Could not load loadouts, please try again.", ephemeral=True)
+        return
+
+    preferred_nations = {n.strip().lower() for n in nations.split(",") if n.strip()} if nations else set()
+    ownership, category_masks, preferred_mask = encode_lineup_candidates(user_ids, vehicles, preferred_nations)
+
+    started = time.perf_counter()
+    picks, unfilled = solve_lineup(ownership, category_masks, preferred_mask, slot_counts)
+    solve_ms = (time.perf_counter() - started) * 1000
+
+    embed = discord.Embed(
+        title=f"🎯 Suggested SQB Lineup • BR {br}",
+        description=f"From **{len(members)}** members in voice" + (f", preferring {nations}" if preferred_nations else ""),
+        color=0xFF9800
+    )
+    for category, label in ROSTER_CATEGORY_LABELS.items():
+        lines = [
+            f"• **{get_warthunder_name(members[candidate])}** — {vehicles[bit]['vehicle_name']} ({vehicles[bit]['nation_name']})"
+            for pick_category, candidate, bit in picks if pick_category == category
+        ]
+        if lines:
+            embed.add_field(name=f"{label} ({len(lines)})", value="\n".join(lines), inline=False)
+    if unfilled:
+        missing = ", ".join(f"{count} {ROSTER_CATEGORY_LABELS[category]}" for category, count in unfilled.items())
+        embed.add_field(name="⚠️ Unfilled slots", value=f"Nobody left with a vehicle for: {missing}", inline=False)
+    embed.set_footer(text=f"Solved in {solve_ms:.1f}ms")
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+# ──────────────── SQUADRON AUDIT ────────────────
+
+AUDIT_PAGE_SIZE = 15
+AUDIT_ISSUES = {
+    'unscraped': "Squadron not scraped yet",
+    'missing': "Not on the squadron page",
+    'inactive': "0 activity",
+    'no_loadout': "No vehicles for the current BR",
+}
+
+async def get_squadron_role_holders(guild, config, squadron_name=None):
+    """Map every member holding a mapped squadron role to their squadron, in one pass over the members"""
+    role_squadrons = {
+        role.id: config['role_squadron_mapping'][role.name]
+        for role in guild.roles
+        if role.name in config['role_squadron_mapping']
+        and (squadron_name is None or config['role_squadron_mapping'][role.name] == squadron_name)
+    }
+    holders = {}
+    for member in await list_guild_members(guild, set(role_squadrons)):
+        if member.bot:
+            continue
+        squadron = next((role_squadrons[role.id] for role in member.roles if role.id in role_squadrons), None)
+        if squadron:
+            holders[member] = squadron
+    return holders
+
+def build_audit_rows(holders, loadout_counts):
+    """One row per role holder with their squadron stats, loadout size and issues, worst first"""
+    rows = []
+    for member, squadron in holders.items():
+        warthunder_name = get_warthunder_name(member)
+        # A squadron that was never scraped says nothing about who is on its page. Near-matches
+        # would hide exactly the members an audit is looking for, so only confirmed names count,
+        # and a remembered mapping only if it wasn't a near-match itself.
+        scraped = player_name_index.has_squadron(squadron)
+        mapped = member_player_map.get(member.id)
+        if mapped and mapped[2] == 'fuzzy':
+            mapped = None
+        stats = player_name_index.resolve(squadron, warthunder_name, mapped, fuzzy=False)[0] if scraped else None
+        vehicles = loadout_counts.get(member.id, 0)
+        issues = set()
+        if not scraped:
+            issues.add('unscraped')
+        elif stats is None:
+            issues.add('missing')
+        elif stats['activity'] == 0:
+            issues.add('inactive')
+        if not vehicles:
+            issues.add('no_loadout')
+        rows.append({
+            'member': member,
+            'warthunder_name': warthunder_name,
+            'squadron': squadron,
+            'points': stats['points'] if stats else None,
+            'activity': stats['activity'] if stats else None,
+            'vehicles': vehicles,
+            'issues': issues,
+        })
+    rows.sort(key=lambda row: (-len(row['issues']), row['squadron'], row['warthunder_name'].lower()))
+    return rows
+
+def build_audit_csv(rows, br):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["member_id", "display_name", "warthunder_name", "squadron", "points", "activity",
+                     f"vehicles_br_{br}", *AUDIT_ISSUES])
+    for row in rows:
+        writer.writerow([
+            row['member'].id, csv_safe(row['member'].display_name), csv_safe(row['warthunder_name']), csv_safe(row['squadron']),
+            "" if row['points'] is None else row['points'],
+            "" if row['activity'] is None else row['activity'],
+            row['vehicles'],
+            *("yes" if issue in row['issues'] else "" for issue in AUDIT_ISSUES)
+        ])
+    return output.getvalue()
+
+def build_audit_pages(rows, br, title_suffix):
+    """Split flagged members into embeds of AUDIT_PAGE_SIZE lines"""
+    counts = {issue: sum(issue in row['issues'] for row in rows) for issue in AUDIT_ISSUES}
+    summary = " • ".join(f"{label}: **{counts[issue]}**" for issue, label in AUDIT_ISSUES.items())
+    flagged = [row for row in rows if row['issues']]
+    pages = []
+    for start in range(0, max(len(flagged), 1), AUDIT_PAGE_SIZE):
+        lines = [
+            f"<@{row['member'].id}> `{row['warthunder_name']}` • {row['squadron']} • "
+            + ", ".join(AUDIT_ISSUES[issue] for issue in AUDIT_ISSUES if issue in row['issues'])
+            for row in flagged[start:start + AUDIT_PAGE_SIZE]
+        ]
+        embed = discord.Embed(
+            title=f"🧾 Squadron Audit{title_suffix} • BR {br}",
+            description=f"**{len(rows)}** role holders, **{len(flagged)}** flagged\n{summary}\n\n" + ("\n".join(lines) or "✅ Nobody flagged"),
+            color=0x795548
+        )
+        pages.append(embed)
+    total = len(pages)
+    for number, embed in enumerate(pages, start=1):
+        embed.set_footer(text=f"Page {number}/{total}")
+    return pages
+
+@bot.tree.command(name="squadron_audit", description="List squadron members missing from the squadron page, inactive, or without vehicles")
+@app_commands.describe(
+    squadron="Only audit this squadron",
+    issue="Only list members with this issue",
+    as_csv="Attach the full report as CSV instead of paged embeds"
+)
+@app_commands.choices(issue=[app_commands.Choice(name=label, value=issue) for issue, label in AUDIT_ISSUES.items()])
+@app_commands.default_permissions(administrator=True)
+@deadline_guarded(thinking=True)
+async def squadron_audit(interaction: discord.Interaction, squadron: str = None, issue: str = None, as_csv: bool = False):
+    config = get_guild_config(interaction.guild.id) if interaction.guild else None
+    if not config:
+        await interaction.followup.send("❌ This server isn't configured for SQB.", ephemeral=True)
+        return
+
+    if not player_name_index.loaded:
+        await interaction.followup.send("❌ Squadron data is still loading, please try again shortly.", ephemeral=True)
+        return
+
+    br = await get_current_battle_rating()
+    if not br:
+        await interaction.followup.send("❌ Could not determine current battle rating.", ephemeral=True)
+        return
+
+    holders = await get_squadron_role_holders(interaction.guild, config, squadron)
+    if not holders:
+        await interaction.followup.send(f"❌ No members hold a role for {f'**{squadron}**' if squadron else 'any squadron'}.", ephemeral=True)
+        return
+
+    await adopt_legacy_rows(holders)
+    try:
+        async with unit_of_work() as conn:
+            counts = await conn.fetch(LOADOUT_COUNTS_SQL, br_param(br), [m.id for m in holders])
+    except Exception as e:
+        print(f"❌ Database error in squadron_audit: {e}")
+        await interaction.followup.send("❌ Could not load loadouts, please try again.", ephemeral=True)
+        return
+
+    rows = build_audit_rows(holders, {row['discord_id']: row['vehicles'] for row in counts})
+    if issue:
+        rows = [row for row in rows if issue in row['issues']]
+    title_suffix = f" • {squadron}" if squadron else ""
+
+    if as_csv:
+        csv_text = await run_in_thread(build_audit_csv, rows, br)
+        file = discord.File(io.BytesIO(csv_text.encode('utf-8')), filename=f"squadron_audit_br{br}.csv")
+        await interaction.followup.send(f"🧾 Squadron audit{title_suffix}: {len(rows)} members", file=file, ephemeral=True)
+        return
+
+    pages = build_audit_pages(rows, br, title_suffix)
+    view = EmbedPagesView(pages) if len(pages) > 1 else discord.utils.MISSING
+    await interaction.followup.send(embed=pages[0], view=view, ephemeral=True)
+
+# ──────────────── VEHICLE SEARCH & /sqb_add ────────────────
+
+SEARCH_MAX_CHOICES = 25        # Discord's autocomplete limit
+SEARCH_PRECOMPUTED_PREFIX = 2  # Prefixes this short match too many tokens to union per keystroke
+SEARCH_REFRESH_DELAY = 2.0     # Coalesce bursts of catalog NOTIFYs into one rebuild
+
+def search_tokens(text):
+    """Split a name into casefolded alphanumeric tokens ("Pz.Kpfw. IV Ausf.H" -> pz, kpfw, iv, ausf, h)"""
+    tokens = []
+    current = []
+    for ch in unicodedata.normalize('NFKC', str(text)).casefold():
+        if ch.isalnum() or ch == '.' and current and current[-1].isdigit():
+            current.append(ch)
+        elif current:
+            tokens.append(''.join(current))
+            current = []
+    if current:
+        tokens.append(''.join(current))
+    return [token.rstrip('.') for token in tokens if token.rstrip('.')]
+
+class VehicleSearchIndex:
+    """Token-prefix index over the whole vehicle catalog for autocomplete.
+
+    Every vehicle is indexed by the tokens of its name, its nation and its BR, so
+    "tiger ger 5.7" narrows to German Tigers at 5.7. Lookups are a bisect into
+    the sorted token list per query word plus set intersections, never a
+    database query. Vehicles are stored shortest name first, so a vehicle's
+    position doubles as its tiebreak rank.
+    """
+
+    def __init__(self):
+        self.vehicles = []          # position -> vehicle row dict
+        self.by_id = {}             # vehicle_id -> vehicle row dict
+        self.by_br = {}             # BR -> frozenset of positions
+        self.tokens = []            # sorted distinct tokens
+        self.postings = []          # parallel to tokens: frozenset of vehicle positions
+        self.short_prefixes = {}    # prefix up to SEARCH_PRECOMPUTED_PREFIX chars -> frozenset of positions
+        self.short_ranked = {}      # same prefixes -> sorted tuple of positions
+        self.short_named = {}       # same prefixes -> sorted tuple of those positions whose name starts with it
+        self.br_ranked = {}         # BR -> sorted tuple of positions
+        self.folded_names = []      # position -> casefolded full name
+        self.names = []             # sorted casefolded full names
+        self.name_positions = []    # parallel to names: vehicle position
+        self.loaded = False
+
+    def build(self, rows):
+        vehicles = sorted((dict(row) for row in rows), key=lambda v: (len(v['vehicle_name']), v['vehicle_name']))
+        token_positions = {}
+        by_br = {}
+        for position, vehicle in enumerate(vehicles):
+            vehicle['vehicle_br'] = normalize_br(vehicle['vehicle_br'])
+            by_br.setdefault(vehicle['vehicle_br'], set()).add(position)
+            for token in set(search_tokens(vehicle['vehicle_name']) + search_tokens(vehicle['nation_name'])) | {vehicle['vehicle_br']}:
+                token_positions.setdefault(token, set()).add(position)
+
+        tokens = sorted(token_positions)
+        short_prefixes = {}
+        for token in tokens:
+            for length in range(1, min(len(token), SEARCH_PRECOMPUTED_PREFIX) + 1):
+                short_prefixes.setdefault(token[:length], set()).update(token_positions[token])
+        folded_names = [v['vehicle_name'].casefold() for v in vehicles]
+        names = sorted((name, position) for position, name in enumerate(folded_names))
+        short_ranked = {prefix: tuple(sorted(positions)) for prefix, positions in short_prefixes.items()}
+
+        # Swap in complete structures so a concurrent autocomplete never sees a half-built index
+        self.vehicles = vehicles
+        self.by_id = {v['vehicle_id']: v for v in vehicles}
+        self.by_br = {br: frozenset(positions) for br, positions in by_br.items()}
+        self.tokens = tokens
+        self.postings = [frozenset(token_positions[token]) for token in tokens]
+        self.short_prefixes = {prefix: frozenset(positions) for prefix, positions in short_prefixes.items()}
+        self.short_ranked = short_ranked
+        self.short_named = {
+            prefix: tuple(p for p in ranked if folded_names[p].startswith(prefix))
+            for prefix, ranked in short_ranked.items()
+        }
+        self.br_ranked = {br: tuple(sorted(positions)) for br, positions in by_br.items()}
+        self.folded_names = folded_names
+        self.names = [name for name, _ in names]
+        self.name_positions = [position for _, position in names]
+        self.loaded = True
+
+    def prefix_matches(self, prefix):
+        """Positions of vehicles with any token starting with prefix"""
+        if len(prefix) <= SEARCH_PRECOMPUTED_PREFIX:
+            return self.short_prefixes.get(prefix, frozenset())
+        start = bisect.bisect_left(self.tokens, prefix)
+        end = bisect.bisect_left(self.tokens, prefix + '\U0010ffff', start)
+        if end - start == 1:
+            return self.postings[start]
+        return frozenset().union(*self.postings[start:end])
+
+    def exact_name_matches(self, name):
+        """Vehicles whose casefolded full name is exactly name (one per nation that has it)"""
+        start = bisect.bisect_left(self.names, name)
+        end = bisect.bisect_right(self.names, name, start)
+        return [self.vehicles[p] for p in self.name_positions[start:end]]
+
+    def name_prefix_matches(self, prefix):
+        """Positions of vehicles whose full name starts with prefix"""
+        start = bisect.bisect_left(self.names, prefix)
+        end = bisect.bisect_left(self.names, prefix + '\U0010ffff', start)
+        return frozenset(self.name_positions[start:end])
+
+    def search(self, query, preferred_br=None, limit=SEARCH_MAX_CHOICES):
+        """Vehicles matching every word of query, best matches first.
+
+        Ranked in tiers: at the preferred BR and name starts with the query,
+        at the preferred BR, name starts with the query, then everything else.
+        """
+        words = search_tokens(query)
+        at_br = self.by_br.get(preferred_br, frozenset())
+        if not words:
+            return [self.vehicles[p] for p in heapq.nsmallest(limit, at_br)]
+        if len(words) == 1 and len(words[0]) <= SEARCH_PRECOMPUTED_PREFIX and words[0] == query.strip().casefold():
+            return [self.vehicles[p] for p in self.search_short_prefix(words[0], preferred_br, limit)]
+
+        matches = sorted((self.prefix_matches(word) for word in words), key=len)
+        positions = matches[0].intersection(*matches[1:])
+        named = positions & self.name_prefix_matches(query.strip().casefold())
+        ranked = []
+        for tier in (named & at_br, positions & at_br, named, positions):
+            if len(ranked) >= limit:
+                break
+            seen = set(ranked)
+            ranked.extend(p for p in heapq.nsmallest(limit + len(ranked), tier) if p not in seen)
+        return [self.vehicles[p] for p in ranked[:limit]]
+
+    def search_short_prefix(self, prefix, preferred_br, limit):
+        """Ranked positions for a lone one or two character word.
+
+        Such a prefix can match most of the catalog, so instead of intersecting
+        and heap-selecting its sets, each tier walks a presorted list and stops
+        once limit positions are found.
+        """
+        positions = self.short_prefixes.get(prefix, frozenset())
+        at_br_ranked = self.br_ranked.get(preferred_br, ())
+        tiers = (
+            (p for p in at_br_ranked if p in positions and self.folded_names[p].startswith(prefix)),
+            (p for p in at_br_ranked if p in positions),
+            self.short_named.get(prefix, ()),
+            self.short_ranked.get(prefix, ()),
+        )
+        ranked = []
+        seen = set()
+        for tier in tiers:
+            for p in tier:
+                if len(ranked) >= limit:
+                    return ranked
+                if p not in seen:
+                    seen.add(p)
+                    ranked.append(p)
+        return ranked
+
+vehicle_search_index = VehicleSearchIndex()
+vehicle_index_refresh_task = None
+
+async def refresh_vehicle_search_index():
+    """Rebuild the search index from the full vehicle catalog"""
+    try:
+        async with unit_of_work() as conn:
+            rows = await conn.fetch(VEHICLE_CATALOG_ALL_SQL)
+    except Exception as e:
+        print(f"❌ Failed to load the vehicle catalog for search: {e}")
+        return
+    await run_in_thread(vehicle_search_index.build, rows)
+    print(f"✅ Vehicle search index rebuilt with {len(rows)} vehicles")
+
+def schedule_vehicle_index_refresh():
+    """Rebuild the search index shortly, once per burst of catalog changes"""
+    global vehicle_index_refresh_task
+    if vehicle_index_refresh_task is not None and not vehicle_index_refresh_task.done():
+        return
+
+    async def refresh_later():
+        await asyncio.sleep(SEARCH_REFRESH_DELAY)
+        await refresh_vehicle_search_index()
+
+    vehicle_index_refresh_task = spawn_background(refresh_later)
+
+def format_search_choice(vehicle):
+    label = f"{vehicle['vehicle_name']} • {vehicle['nation_name']} • BR {vehicle['vehicle_br']} • {vehicle['vehicle_type']}"
+    return app_commands.Choice(name=label[:100], value=f"id:{vehicle['vehicle_id']}")
+
+async def vehicle_autocomplete(interaction: discord.Interaction, current: str):
+    # Only a cached BR is used for ranking; a keystroke never waits on the database
+    cached = schedule_cache.get('current')
+    preferred_br = cached['br'] if cached is not None and cached['expires'] > time.monotonic() else None
+    return [format_search_choice(v) for v in vehicle_search_index.search(current, preferred_br)]
+
+@bot.tree.command(name="sqb_add", description="Add a single vehicle to your list by searching the catalog")
+@app_commands.describe(vehicle="Start typing a vehicle name, nation or BR")
+@app_commands.autocomplete(vehicle=vehicle_autocomplete)
+@deadline_guarded()
+async def sqb_add(interaction: discord.Interaction, vehicle: str):
+    if not vehicle_search_index.loaded:
+        await interaction.followup.send("❌ The vehicle catalog is still loading, please try again shortly.", ephemeral=True)
+        return
+
+    # A picked suggestion carries "id:<vehicle ID>". Typed text, digits included, only counts if it
+    # is exactly one vehicle's full name; anything looser could add the wrong vehicle.
+    vehicle_id = vehicle[3:] if vehicle.startswith("id:") else ""
+    if vehicle_id.isdigit():
+        chosen = vehicle_search_index.by_id.get(int(vehicle_id))
+    else:
+        matches = vehicle_search_index.exact_name_matches(' '.join(vehicle.split()).casefold())
+        if len(matches) > 1:
+            nations = ", ".join(sorted(match['nation_name'] for match in matches))
+            await interaction.followup.send(
+                f"❌ **{vehicle}** exists for several nations ({nations}), please pick one from the suggestions.",
+                ephemeral=True
+            )
+            return
+        chosen = matches[0] if matches else None
+    if chosen is None:
+        await interaction.followup.send(
+            f"❌ No vehicle is named **{vehicle}**, please pick one from the suggestions as you type.", ephemeral=True
+        )
+        return
+
+    member = interaction.user
+    user_id = member.id
+    warthunder_user = get_warthunder_name(member)
+    await adopt_legacy_rows([member])
+    try:
+        added = await store_user_vehicle(user_id, chosen['vehicle_id'], warthunder_user)
+    except DATABASE_ERRORS as e:
+        print(f"❌ Could not add vehicle {chosen['vehicle_id']} for {user_id}: {e!r}")
+        await interaction.followup.send("❌ Could not save the vehicle, please try again in a moment.", ephemeral=True)
+        return
+    if not added:
+        await interaction.followup.send(f"ℹ️ **{chosen['vehicle_name']}** is already in your vehicles.", ephemeral=True)
+        return
+
+    br = await get_current_battle_rating()
+    if br == chosen['vehicle_br'] and member.voice and is_monitored_voice_channel(member.voice.channel):
+        await post_user_vehicles_and_cleanup(member, user_id, warthunder_user, br)
+
+    await interaction.followup.send(
+        f"✅ Added **{chosen['vehicle_name']}** ({chosen['nation_name']}, BR {chosen['vehicle_br']}) to your vehicles.",
+        ephemeral=True
+    )
+
+# ──────────────── VEHICLE CATALOG IMPORT ────────────────
+
+# Accepted column names (lowercase) for each catalog field, first match wins
+CATALOG_IMPORT_COLUMNS = {
+    'vehicle_name': ('vehicle_name', 'name'),
+    'nation': ('nation', 'nation_name', 'nation_id', 'country'),
+    'vehicle_type': ('vehicle_type', 'type'),
+    'vehicle_br': ('vehicle_br', 'br', 'battle_rating')
+}
+CATALOG_STAGING_COLUMNS = ['vehicle_name', 'nation_id', 'vehicle_type', 'vehicle_br', 'row_hash']
+CATALOG_IMPORT_MAX_RETIRE_SHARE = 0.25  # Refuse to retire more than this share of an imported nation's vehicles
+CATALOG_IMPORT_SUMMARY_FIELDS = ('listed', 'inserted', 'rerated', 'retyped', 'restored', 'active', 'retiring')
+CATALOG_IMPORT_MAX_PROBLEMS_SHOWN = 10
+CATALOG_IMPORT_BR_RANGE = (decimal.Decimal('1.0'), decimal.Decimal('14.9'))  # Lowest BR to the top of the current 14.x tier
+
+def catalog_row_hash(vehicle_name, nation_id, vehicle_type, vehicle_br):
+    return hashlib.sha1(f"{vehicle_name}\x1f{nation_id}\x1f{vehicle_type}\x1f{vehicle_br}".encode('utf-8')).hexdigest()
+
+def parse_catalog_file(filename, data, nation_ids):
+    """Parse a CSV or JSON catalog export into staging records (runs in a worker thread).
+
+    nation_ids maps casefolded nation names to IDs; numeric nation values are taken
+    as IDs. Returns (records, problems), one record per (nation, vehicle name).
+    """
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json'):
+        items = json.loads(text)
+        if isinstance(items, dict):
+            items = items.get('vehicles', [])
+    else:
+        items = list(csv.DictReader(io.StringIO(text)))
+
+    known_ids = set(nation_ids.values())
+    records = {}
+    problems = []
+    for line, item in enumerate(items, start=1):
+        item = {str(key).strip().lower(): value for key, value in item.items()}
+        values = {
+            field: next((item[alias] for alias in aliases if item.get(alias) not in (None, '')), None)
+            for field, aliases in CATALOG_IMPORT_COLUMNS.items()
+        }
+        missing = [field for field, value in values.items() if value is None]
+        if missing:
+            problems.append(f"row {line}: missing {', '.join(missing)}")
+            continue
+
+        nation = str(values['nation']).strip()
+        nation_id = int(nation) if nation.isdigit() and int(nation) in known_ids else nation_ids.get(nation.casefold())
+        if nation_id is None:
+            problems.append(f"row {line}: unknown nation '{nation}'")
+            continue
+        try:
+            vehicle_br = decimal.Decimal(str(values['vehicle_br']).strip()).quantize(decimal.Decimal('0.1'))
+            if not vehicle_br.is_finite():
+                raise decimal.InvalidOperation
+        except decimal.InvalidOperation:
+            problems.append(f"row {line}: invalid BR '{values['vehicle_br']}'")
+            continue
+        low, high = CATALOG_IMPORT_BR_RANGE
+        if not low <= vehicle_br <= high:
+            problems.append(f"row {line}: BR '{values['vehicle_br']}' is outside {low}-{high}")
+            continue
+
+        vehicle_name = ' '.join(str(values['vehicle_name']).split())
+        vehicle_type = str(values['vehicle_type']).strip()
+        key = (nation_id, vehicle_name)
+        if key in records:
+            problems.append(f"row {line}: duplicate of an earlier row for {vehicle_name}, the later row wins")
+        records[key] = (vehicle_name, nation_id, vehicle_type, vehicle_br,
+                        catalog_row_hash(vehicle_name, nation_id, vehicle_type, vehicle_br))
+    return list(records.values()), problems
+
+async def import_vehicle_catalog(records, dry_run=False, allow_mass_retire=False):
+    """Stage an import with COPY and merge it into vehicle_table in one transaction.
+
+    Returns the change summary, totalled over the imported nations, with the
+    nations the import would retire an implausible share of in 'mass_retire'.
+    Nothing is written on a dry run or when any nation is in that list.
+    """
+    async with unit_of_work() as conn:
+        await conn.execute(CATALOG_STAGING_DDL)
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            await conn.copy_records_to_table('catalog_staging', records=records, columns=CATALOG_STAGING_COLUMNS)
+            by_nation = await conn.fetch(CATALOG_IMPORT_DIFF_SQL)
+            summary = {field: sum(row[field] for row in by_nation) for field in CATALOG_IMPORT_SUMMARY_FIELDS}
+            summary['mass_retire'] = [
+                (row['nation_id'], row['retiring'], row['active'])
+                for row in by_nation if row['retiring'] > CATALOG_IMPORT_MAX_RETIRE_SHARE * row['active']
+            ]
+            summary['applied'] = False
+            summary['blocked'] = not allow_mass_retire and bool(summary['mass_retire'])
+            if dry_run or summary['blocked']:
+                await transaction.rollback()
+                return summary
+
+            await conn.execute(CATALOG_IMPORT_UPDATE_SQL)
+            await conn.execute(CATALOG_IMPORT_INSERT_SQL)
+            await conn.execute(CATALOG_IMPORT_RETIRE_SQL)
+        except BaseException:
+            await transaction.rollback()
+            raise
+        await transaction.commit()
+
+    # Other instances hear about it through the vehicle_table NOTIFYs; don't wait for ours to come back
+    catalog_cache.clear()
+    loadout_cache.clear()
+    schedule_vehicle_index_refresh()
+    summary['applied'] = True
+    return summary
+
+@bot.tree.command(name="catalog_import", description="Import a vehicle catalog export and apply what changed")
+@app_commands.describe(
+    file="CSV or JSON export with vehicle name, nation, type and BR columns",
+    dry_run="Only report what would change",
+    allow_mass_retire=f"Allow retiring more than {CATALOG_IMPORT_MAX_RETIRE_SHARE:.0%} of an imported nation's vehicles"
+)
+@app_commands.default_permissions(administrator=True)
+@deadline_guarded(thinking=True)
+async def catalog_import(interaction: discord.Interaction, file: discord.Attachment, dry_run: bool = False, allow_mass_retire: bool = False):
+    # The catalog is shared by every guild, so only the home guild's admins may change it
+    if not await require_home_guild(interaction, "Importing the vehicle catalog"):
+        return
+
+    started = time.monotonic()
+    try:
+        async with unit_of_work() as conn:
+            nations = await conn.fetch(NATIONS_SQL)
+        nation_ids = {row['nation_name'].casefold(): row['nation_id'] for row in nations}
+        records, problems = await run_in_thread(parse_catalog_file, file.filename, await file.read(), nation_ids)
+    except (ValueError, csv.Error) as e:
+        await interaction.followup.send(f"❌ Could not read **{file.filename}**: {e}", ephemeral=True)
+        return
+    except Exception as e:
+        print(f"❌ Catalog import failed while loading {file.filename}: {e}")
+        await interaction.followup.send("❌ Catalog import failed, see the bot logs.", ephemeral=True)
+        return
+
+    if not records:
+        await interaction.followup.send(f"❌ No usable rows in **{file.filename}** ({len(problems)} problems).", ephemeral=True)
+        return
+
+    try:
+        summary = await import_vehicle_catalog(records, dry_run, allow_mass_retire)
+    except Exception as e:
+        print(f"❌ Catalog import failed while merging {file.filename}: {e}")
+        await interaction.followup.send("❌ Catalog import failed, nothing was changed. See the bot logs.", ephemeral=True)
+        return
+
+    if summary['applied']:
+        title, color = "✅ Catalog Imported", 0x4CAF50
+    elif summary['blocked']:
+        title, color = "⚠️ Catalog Import Blocked", 0xFF9800
+    else:
+        title, color = "🔍 Catalog Import Dry Run", 0x2196F3
+    embed = discord.Embed(
+        title=title,
+        description=f"**{summary['listed']}** vehicles in **{file.filename}**, processed in {time.monotonic() - started:.1f}s",
+        color=color
+    )
+    embed.add_field(name="New", value=str(summary['inserted']), inline=True)
+    embed.add_field(name="BR changes", value=str(summary['rerated']), inline=True)
+    embed.add_field(name="Type changes", value=str(summary['retyped']), inline=True)
+    embed.add_field(name="Retired", value=f"{summary['retiring']} of {summary['active']}", inline=True)
+    embed.add_field(name="Restored", value=str(summary['restored']), inline=True)
+    if summary['blocked']:
+        nation_names = {row['nation_id']: row['nation_name'] for row in nations}
+        over = ", ".join(
+            f"{nation_names.get(nation_id, nation_id)} ({retiring} of {active})"
+            for nation_id, retiring, active in summary['mass_retire']
+        )
+        embed.add_field(
+            name="Why it was blocked",
+            value=(f"It would retire more than {CATALOG_IMPORT_MAX_RETIRE_SHARE:.0%} of the vehicles of: {over}. "
+                   "Check the file is a complete export, or rerun with `allow_mass_retire`.")[:1024],
+            inline=False
+        )
+    if problems:
+        shown = "\n".join(problems[:CATALOG_IMPORT_MAX_PROBLEMS_SHOWN])
+        more = f"\n…and {len(problems) - CATALOG_IMPORT_MAX_PROBLEMS_SHOWN} more" if len(problems) > CATALOG_IMPORT_MAX_PROBLEMS_SHOWN else ""
+        embed.add_field(name=f"⚠️ Row problems ({len(problems)})", value=(shown + more)[:1024], inline=False)
+    print(f"✅ Catalog import of {file.filename} by {interaction.user}: {summary}")
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+# ──────────────── EVENT LOOP WATCHDOG & CPU OFFLOAD ────────────────
+
+LOOP_LAG_CHECK_INTERVAL = 0.1  # Seconds between loop heartbeats
+LOOP_LAG_WARN_SECONDS = 0.25   # Stalls longer than this are logged with the running stack
+
+class LoopLagWatchdog:
+    """Measure event loop lag and report what was running during each stall.
+
+    A heartbeat callback on the loop stamps the time every interval. A daemon
+    thread watches that stamp and, when the loop stops ticking, samples the
+    loop thread's stack so the log shows which coroutine was holding it.
+    """
+
+    def __init__(self, interval=LOOP_LAG_CHECK_INTERVAL, threshold=LOOP_LAG_WARN_SECONDS):
+        self.interval = interval
+        self.threshold = threshold
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self._reported_beat = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, loop):
+        """Start watching; must be called from the loop's own thread"""
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._stop.clear()
+        loop.call_soon(self._beat, self.last_beat)
+        self._thread = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _beat(self, expected):
+        now = time.monotonic()
+        lag = now - expected
+        self.last_beat = now
+        if lag > self.max_lag:
+            self.max_lag = lag
+        if lag > self.threshold:
+            self.stall_count += 1
+            print(f"⚠️ Event loop resumed after a {lag:.3f}s stall")
+        if not self._stop.is_set():
+            self.loop.call_later(self.interval, self._beat, now + self.interval)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            beat = self.last_beat
+            stalled_for = time.monotonic() - beat - self.interval
+            if stalled_for < self.threshold or self._reported_beat == beat:
+                continue
+            self._reported_beat = beat
+            print(f"⚠️ Event loop stalled for {stalled_for:.3f}s, running: {self._describe_running()}")
+
+    def _describe_running(self):
+        """Describe the task and stack currently holding the loop thread"""
+        task_name = "<no task>"
+        try:
+            task = asyncio.current_task(self.loop)
+            if task is not None:
+                coro = task.get_coro()
+                task_name = f"{task.get_name()} ({getattr(coro, '__qualname__', coro)})"
+        except Exception:
+            pass
+
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return task_name
+        stack = "".join(traceback.format_stack(frame, limit=8))
+        return f"{task_name}\n{stack}"
+
+loop_watchdog = LoopLagWatchdog()
+
+# Thread pool for blocking calls, process pool for pure CPU-bound work (HTML parsing, bulk diffing,
+# report generation). The process pool spawns fresh interpreters: by the time it's first used the
+# watchdog, executor and aiohttp threads exist, and forking a threaded process can deadlock the child.
+# Spawned workers re-import this script as __mp_main__, which defines everything without connecting.
+thread_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="wtbot-worker")
+process_executor = None
+
+def get_process_executor():
+    global process_executor
+    if process_executor is None:
+        process_executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"))
+    return process_executor
+
+async def run_in_thread(func, *args, **kwargs):
+    """Run a blocking function in the worker thread pool without stalling the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(thread_executor, functools.partial(func, *args, **kwargs))
+
+async def run_cpu_bound(func, *args):
+    """Run a CPU-heavy function in the process pool.
+
+    func must be a module-level function and args plain picklable data. Falls
+    back to the thread pool if the process pool is broken or unavailable.
+    """
+    global process_executor
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_process_executor(), func, *args)
+    except BrokenProcessPool:
+        print("❌ Process pool broken, recreating it and running job in a thread")
+        process_executor = None
+    except (OSError, ValueError) as e:
+        print(f"❌ Process pool unavailable ({e}), running job in a thread")
+    return await run_in_thread(func, *args)
+
+# ──────────────── ON-DEMAND PROFILING ────────────────
+
+PROFILE_DIR = "profiles"
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples of the loop thread
+PROFILE_TOP_FUNCTIONS = 30
+
+# Handlers that can be profiled, as (object, attribute) holding the callable dispatch looks up on
+# every call. Swapping that attribute in and out means nothing is installed while profiling is off.
+PROFILE_TARGETS = {
+    'on_voice_state_update': lambda: (bot, 'on_voice_state_update'),
+    'SaveVehiclesButton.callback': lambda: (SaveVehiclesButton, 'callback'),
+    'update_squadron_data': lambda: (update_squadron_data, 'coro'),
+}
+PROFILE_WHOLE_LOOP = 'event loop'
+
+active_profile_session = None
+
+class ProfileSession:
+    """One profiling run, either cProfile or stack sampling of the event loop thread.
+
+    With a target handler, capture is on only while an invocation of it is
+    running. Handlers await, so other coroutines that run in the meantime are
+    captured too; the profile shows what the loop was busy with while the
+    handler was in flight.
+    """
+
+    def __init__(self, target, mode, max_invocations):
+        self.target = target
+        self.mode = mode
+        self.max_invocations = max_invocations
+        self.invocations = 0
+        self.started = time.time()
+        self.done = asyncio.Event()
+        self.finished = False
+        self.depth = 0
+        self.profiler = cProfile.Profile() if mode == 'cprofile' else None
+        self.samples = collections.Counter()
+        self.capturing = False
+        self.loop_thread_id = threading.get_ident()
+        self._sampler = None
+        self._stop = threading.Event()
+        self._owner = None
+        self._attribute = None
+        self._original = None
+
+    def start(self):
+        if self.mode == 'sampling':
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+        if self.target == PROFILE_WHOLE_LOOP:
+            self._begin()
+            return
+        self._owner, self._attribute = PROFILE_TARGETS[self.target]()
+        self._original = getattr(self._owner, self._attribute)
+        setattr(self._owner, self._attribute, self._wrap(self._original))
+
+    def finish(self):
+        """Restore the handler and stop capturing; safe to call more than once"""
+        if self.finished:
+            return
+        self.finished = True
+        if self._owner is not None:
+            setattr(self._owner, self._attribute, self._original)
+        if self.depth:
+            self.depth = 1
+            self._end()
+        self._stop.set()
+        self.done.set()
+
+    def _wrap(self, func):
+        session = self
+
+        @functools.wraps(func)
+        async def profiled(*args, **kwargs):
+            if session.finished:
+                return await func(*args, **kwargs)
+            session._begin()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                if not session.finished:
+                    session._end()
+                    session.invocations += 1
+                    if session.max_invocations and session.invocations >= session.max_invocations:
+                        session.finish()
+        return profiled
+
+    def _begin(self):
+        # Overlapping invocations share one capture; cProfile can't be enabled twice
+        self.depth += 1
+        if self.depth == 1:
+            if self.profiler is not None:
+                self.profiler.enable()
+            self.capturing = True
+
+    def _end(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self.capturing = False
+            if self.profiler is not None:
+                self.profiler.disable()
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL):
+            if not self.capturing:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[tuple(reversed(stack))] += 1
+
+def write_profile_results(session):
+    """Write the raw profile and a top-functions summary to PROFILE_DIR; returns (summary path, summary text)"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stem = os.path.join(PROFILE_DIR, f"{session.target.replace(' ', '_')}_{session.mode}_{datetime.now():%Y%m%d_%H%M%S}")
+    header = (f"{session.mode} profile of {session.target}: {session.invocations} invocations, "
+              f"{time.time() - session.started:.1f}s wall time\n\n")
+
+    if session.profiler is not None:
+        session.profiler.dump_stats(f"{stem}.prof")
+        buffer = io.StringIO()
+        pstats.Stats(session.profiler, stream=buffer).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        summary = header + buffer.getvalue()
+    else:
+        # Collapsed stacks, loadable by flamegraph.pl or speedscope
+        with open(f"{stem}.folded", 'w', encoding='utf-8') as f:
+            for stack, count in session.samples.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+        total = sum(session.samples.values())
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        for stack, count in session.samples.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                inclusive[function] += count
+        lines = [header + f"{total} samples every {PROFILE_SAMPLE_INTERVAL * 1000:.0f}ms", "", "Top functions by own samples:"]
+        lines += [f"{count / total:7.1%}  {function}" for function, count in own.most_common(PROFILE_TOP_FUNCTIONS)] if total else []
+        lines += ["", "Top functions by inclusive samples:"]
+        lines += [f"{count / total:7.1%}  {function}" for function, count in inclusive.most_common(PROFILE_TOP_FUNCTIONS)] if total else []
+        summary = "\n".join(lines) + "\n"
+
+    with open(f"{stem}.txt", 'w', encoding='utf-8') as f:
+        f.write(summary)
+    return f"{stem}.txt", summary
+
+async def complete_profile_session(interaction, session, seconds):
+    """Wait for the session to hit its invocation count or duration, then post the results"""
+    global active_profile_session
+    try:
+        await asyncio.wait_for(session.done.wait(), timeout=seconds)
+    except asyncio.TimeoutError:
+        pass
+    session.finish()
+    active_profile_session = None
+
+    try:
+        summary_path, summary = await run_in_thread(write_profile_results, session)
+    except Exception as e:
+        print(f"❌ Failed to write profile results: {e}")
+        await interaction.followup.send("❌ Profiling finished but the results could not be written.", ephemeral=True)
+        return
+    print(f"✅ Profile of {session.target} written to {summary_path}")
+    preview = summary[:1500]
+    await interaction.followup.send(
+        f"🔬 Profile of **{session.target}** finished, saved to `{summary_path}`.\n```\n{preview}\n```",
+        file=discord.File(summary_path),
+        ephemeral=True
+    )
+
+@bot.tree.command(name="profile", description="Profile a live handler or the whole event loop")
+@app_commands.describe(
+    target="Handler to profile, or the whole event loop",
+    mode="Stack sampling (low overhead) or cProfile (exact call counts, slower)",
+    seconds="Stop after this many seconds",
+    invocations="Stop after this many handler invocations (0 = run for the full duration)"
+)
+@app_commands.choices(
+    target=[app_commands.Choice(name=name, value=name) for name in [PROFILE_WHOLE_LOOP, *PROFILE_TARGETS]],
+    mode=[app_commands.Choice(name="sampling", value="sampling"), app_commands.Choice(name="cProfile", value="cprofile")]
+)
+@app_commands.default_permissions(administrator=True)
+@deadline_guarded()
+async def profile_command(
+    interaction: discord.Interaction,
+    target: str,
+    mode: str = "sampling",
+    seconds: app_commands.Range[int, 1, 600] = 60,
+    invocations: app_commands.Range[int, 0, 1000] = 0
+):
+    global active_profile_session
+    if not await require_home_guild(interaction, "Profiling"):
+        return
+    if active_profile_session is not None:
+        await interaction.followup.send(f"❌ Already profiling **{active_profile_session.target}**, wait for it to finish.", ephemeral=True)
+        return
+
+    session = ProfileSession(target, mode, invocations if target != PROFILE_WHOLE_LOOP else 0)
+    try:
+        session.start()
+    except ValueError as e:
+        # cProfile refuses to start while another profiler is active in the process
+        await interaction.followup.send(f"❌ Could not start profiling: {e}", ephemeral=True)
+        return
+    active_profile_session = session
+
+    limit = f"{invocations} invocations or {seconds}s" if session.max_invocations else f"{seconds}s"
+    print(f"🔬 Profiling {target} ({mode}) for up to {limit}, requested by {interaction.user}")
+    await interaction.followup.send(f"🔬 Profiling **{target}** with {mode} for up to {limit}. Results will be posted here.", ephemeral=True)
+    asyncio.get_running_loop().create_task(complete_profile_session(interaction, session, seconds))
 
 # ──────────────── UTILITY FUNCTIONS ────────────────
 
@@ -903,6 +3887,33 @@ def clean_player_name(player_name):
     
     return cleaned_name.strip()
 
+def get_warthunder_name(member):
+    """Get a member's War Thunder name from their nickname ("Name | anything"), falling back to their username"""
+    if member.nick and "|" in member.nick:
+        return member.nick.split("|")[0].strip()
+    return (member.nick or member.name).strip()
+
+GROUND_VEHICLE_TYPES = {'tank', 'ground', 'medium tank', 'heavy tank', 'light tank', 'tank destroyer'}
+SPAA_VEHICLE_TYPES = {'spaa', 'anti-aircraft'}
+AIR_VEHICLE_TYPES = {'aircraft', 'air', 'fighter', 'bomber', 'attacker'}
+HELI_VEHICLE_TYPES = {'helicopter', 'heli'}
+
+@functools.lru_cache(maxsize=None)
+def categorize_vehicle_type(vehicle_type):
+    """Map a vehicle_type from the database to its selection menu category"""
+    vtype = vehicle_type.lower()
+    if vtype in GROUND_VEHICLE_TYPES:
+        return 'ground'
+    elif vtype in SPAA_VEHICLE_TYPES:
+        return 'spaa'
+    elif vtype in AIR_VEHICLE_TYPES:
+        return 'air'
+    elif vtype in HELI_VEHICLE_TYPES:
+        return 'heli'
+    # If we don't recognize the type, put it in ground as default
+    print(f"Debug: Unknown vehicle type '{vtype}', treating as ground")
+    return 'ground'
+
 # ──────────────── UI CLASSES ────────────────
 
 def format_vehicle_label(vehicle_name, nation_name):
@@ -922,206 +3933,223 @@ def format_vehicle_label(vehicle_name, nation_name):
     
     return label
 
+MENU_CATEGORY_ORDER = ['ground', 'spaa', 'air', 'heli']
+SELECT_PAGE_SIZE = 25  # Discord's limit on options in one select menu
+
+class VehicleMenuPage:
+    """One page of a category's select options, prebuilt in plain and preselected variants"""
+    __slots__ = ('vehicle_ids', 'plain', 'preselected')
+
+    def __init__(self, vehicles):
+        self.vehicle_ids = [v['vehicle_id'] for v in vehicles]
+        self.plain = [
+            discord.SelectOption(label=format_vehicle_label(v['vehicle_name'], v['nation_name']), value=str(v['vehicle_id']))
+            for v in vehicles
+        ]
+        self.preselected = [discord.SelectOption(label=o.label, value=o.value, default=True) for o in self.plain]
+
+    def options(self, selected_ids):
+        """The page's options for one user, picking the prebuilt variant of each instead of building new ones"""
+        return [
+            chosen if vehicle_id in selected_ids else plain
+            for vehicle_id, plain, chosen in zip(self.vehicle_ids, self.plain, self.preselected)
+        ]
+
+class VehicleMenu:
+    """A category's vehicles at one BR, split into select menu pages shared by every user"""
+
+    def __init__(self, category, vehicles):
+        self.category = category
+        self.vehicle_ids = frozenset(v['vehicle_id'] for v in vehicles)
+        self.pages = [VehicleMenuPage(vehicles[i:i + SELECT_PAGE_SIZE]) for i in range(0, len(vehicles), SELECT_PAGE_SIZE)]
+
+vehicle_menus = {}  # BR -> (catalog rows the menus were built from, {category: VehicleMenu})
+
+async def get_vehicle_menus(br):
+    """The selection menus for a BR, rebuilt only when the catalog rows for the BR change"""
+    vehicles = await get_all_vehicles_for_br(br)
+    built = vehicle_menus.get(br)
+    # The catalog cache hands out the same list until the BR is invalidated and reloaded
+    if built is not None and built[0] is vehicles:
+        return built[1]
+
+    by_category = {category: [] for category in MENU_CATEGORY_ORDER}
+    for v in vehicles:
+        by_category[categorize_vehicle_type(v['vehicle_type'])].append(v)
+    menus = {category: VehicleMenu(category, rows) for category, rows in by_category.items()}
+    vehicle_menus[br] = (vehicles, menus)
+    return menus
+
 class VehicleSelect(discord.ui.Select):
-    def __init__(self, vehicle_options, user_id, warthunder_user, is_air, next_callback=None, selected_ids=None):
-        options = []
-        
-        # Only process vehicles if we have any
-        if vehicle_options:
-            for v in vehicle_options[:25]:  # Discord limit is 25 options
-                label = format_vehicle_label(v['vehicle_name'], v['nation_name'])
-                
-                options.append(discord.SelectOption(
-                    label=label,
-                    value=str(v['vehicle_id']),
-                    default=(str(v['vehicle_id']) in selected_ids) if selected_ids else False
-                ))
-
-        # If no options were created, add a placeholder
-        if not options:
-            options = [discord.SelectOption(label="No vehicles available", value="none")]
-            is_disabled = True
+    """The page of a category menu being shown; picks update the view's selection, nothing is saved yet"""
+
+    def __init__(self, page, selected_ids):
+        if page is None:
+            super().__init__(
+                placeholder="No vehicles available",
+                options=[discord.SelectOption(label="No vehicles available", value="none")],
+                disabled=True,
+                row=0
+            )
         else:
-            is_disabled = False
+            super().__init__(
+                placeholder="Select vehicles...",
+                min_values=0,
+                max_values=len(page.vehicle_ids),
+                options=page.options(selected_ids),
+                row=0
+            )
 
-        super().__init__(
-            placeholder="Select vehicles..." if not is_disabled else "No vehicles available",
-            min_values=0,
-            max_values=min(10, len(options)) if not is_disabled else 1,
-            options=options,
-            disabled=is_disabled
-        )
+    @deadline_guarded()
+    async def callback(self, interaction: discord.Interaction):
+        view = self.view
+        page = view.menu.pages[view.page_index]
+        # Only this page's picks are replaced, selections on other pages stay as they were
+        view.selected_ids.difference_update(page.vehicle_ids)
+        view.selected_ids.update(int(vid) for vid in self.values if vid != "none")
+        await view.show(interaction)
 
+class VehicleSelectionView(discord.ui.View):
+    """Paginated selection of one category's vehicles, saved as a whole with the Save button"""
+
+    def __init__(self, menu, user_id, warthunder_user, br, selected_ids, next_callback=None):
+        super().__init__(timeout=300)
+        self.menu = menu
         self.user_id = user_id
         self.warthunder_user = warthunder_user
-        self.is_air = is_air
+        self.br = br
+        self.selected_ids = set(selected_ids) & menu.vehicle_ids
         self.next_callback = next_callback
+        self.page_index = 0
+        self.vehicle_select = None
+        self.saving = False
+
+        if len(menu.pages) > 1:
+            self.previous_button = MenuPageButton(-1)
+            self.next_button = MenuPageButton(1)
+            self.add_item(self.previous_button)
+            self.add_item(self.next_button)
+        self.add_item(SaveVehiclesButton())
+        self.render()
+
+    def render(self):
+        """Swap in the select for the current page and update the page buttons"""
+        if self.vehicle_select is not None:
+            self.remove_item(self.vehicle_select)
+        page = self.menu.pages[self.page_index] if self.menu.pages else None
+        self.vehicle_select = VehicleSelect(page, self.selected_ids)
+        self.add_item(self.vehicle_select)
+        if len(self.menu.pages) > 1:
+            self.previous_button.disabled = self.page_index == 0
+            self.next_button.disabled = self.page_index == len(self.menu.pages) - 1
+
+    def content(self):
+        category = self.menu.category.upper()
+        if not self.menu.pages:
+            return f"📋 No **{category}** vehicles available for BR {self.br}. Click Save to continue."
+        text = f"📋 Select your **{category}** vehicles for BR {self.br}"
+        if len(self.menu.pages) > 1:
+            text += f" (page {self.page_index + 1}/{len(self.menu.pages)})"
+        return f"{text}: **{len(self.selected_ids)}** selected, click Save when done."
+
+    async def show(self, interaction):
+        self.render()
+        await interaction.edit_original_response(content=self.content(), view=self)
+
+class MenuPageButton(discord.ui.Button):
+    def __init__(self, step):
+        super().__init__(
+            style=discord.ButtonStyle.secondary,
+            label="Previous page" if step < 0 else "Next page",
+            emoji="⬅️" if step < 0 else "➡️",
+            row=1
+        )
+        self.step = step
 
+    @deadline_guarded()
     async def callback(self, interaction: discord.Interaction):
-        await interaction.response.defer(thinking=False, ephemeral=True)
+        view = self.view
+        view.page_index = min(max(view.page_index + self.step, 0), len(view.menu.pages) - 1)
+        await view.show(interaction)
 
-        print(f"Debug: VehicleSelect callback - disabled: {self.disabled}, values: {self.values}")
+class SaveVehiclesButton(discord.ui.Button):
+    def __init__(self):
+        super().__init__(style=discord.ButtonStyle.primary, label="Save", emoji="✅", row=1)
 
-        if self.disabled or not self.values or "none" in self.values:
-            print("Debug: Skipping to next callback (no vehicles or disabled)")
-            if self.next_callback:
-                await self.next_callback()
-            else:
-                await interaction.followup.send("✅ Vehicle selection complete.", ephemeral=True)
+    @deadline_guarded()
+    async def callback(self, interaction: discord.Interaction):
+        view = self.view
+        if view.saving:
+            return  # A double click; the first save answers
+        view.saving = True
+
+        # Diff and apply the selection in one transaction. Only vehicles of this menu's category
+        # are touched, the other categories have their own menus.
+        try:
+            async with unit_of_work() as conn:
+                async with conn.transaction():
+                    rows = await conn.fetch(USER_VEHICLE_IDS_SQL, view.user_id, list(view.menu.vehicle_ids))
+                    existing_ids = {row['vehicle_id'] for row in rows}
+                    added_ids = view.selected_ids - existing_ids
+                    removed_ids = existing_ids - view.selected_ids
+                    print(f"Debug: Saving {view.menu.category} for user {view.user_id}: +{sorted(added_ids)} -{sorted(removed_ids)}")
+                    if added_ids:
+                        await conn.execute(INSERT_USER_VEHICLES_SQL, view.user_id, list(added_ids), view.warthunder_user)
+                    if removed_ids:
+                        await conn.execute(DELETE_USER_VEHICLES_SQL, view.user_id, list(removed_ids))
+        except DATABASE_ERRORS as e:
+            # The menu stays open with the picks intact, so saving again is one click
+            view.saving = False
+            print(f"❌ Could not save vehicle selection for {view.user_id}: {e!r}")
+            message = "The database is busy" if isinstance(e, PoolExhaustedError) else "Could not save your selection"
+            await interaction.followup.send(f"❌ {message}, please press Save again in a moment.", ephemeral=True)
             return
 
-        selected_ids = {int(vid) for vid in self.values}
-        print(f"Debug: Selected vehicle IDs: {selected_ids}")
+        view.stop()
+        if added_ids or removed_ids:
+            # Invalidate locally once committed rather than waiting for our own NOTIFY to come back
+            loadout_cache.invalidate(view.user_id)
 
-        async with db_pool.acquire() as conn:
-            br_row = await conn.fetchrow("""
-                SELECT sqb_br FROM sqb_schedule
-                WHERE NOW() BETWEEN sqb_date AND end_date
-                LIMIT 1
-            """)
-            if not br_row:
-                await interaction.followup.send("❌ Failed to fetch BR.", ephemeral=True)
-                return
-            br = str(br_row['sqb_br']).rstrip('.0')
-
-            # Get the vehicle IDs that are currently being shown in this selection menu
-            current_menu_vehicle_ids = set()
-            async with db_pool.acquire() as conn2:
-                # Get all vehicles for this BR and determine which ones are in the current menu
-                all_vehicles = await conn2.fetch("""
-                    SELECT vt.vehicle_id, vt.vehicle_name, vt.vehicle_type, n.nation_name
-                    FROM vehicle_table vt
-                    JOIN nations n ON vt.nation_id = n.nation_id
-                    WHERE TRIM(TRAILING '.0' FROM vt.vehicle_br::TEXT) = $1
-                """, br)
-                
-                # Get current vehicle type from the first option in our menu
-                if hasattr(self, 'options') and self.options and self.options[0].value != "none":
-                    first_vehicle_id = int(self.options[0].value)
-                    for v in all_vehicles:
-                        if v['vehicle_id'] == first_vehicle_id:
-                            current_vehicle_type = v['vehicle_type'].lower()
-                            break
-                    
-                    # Collect all vehicle IDs of the same type as what's being shown
-                    for v in all_vehicles:
-                        vtype = v['vehicle_type'].lower()
-                        # Use the same categorization logic as in sqb_queue
-                        categorized_type = None
-                        if vtype in ['tank', 'ground', 'medium tank', 'heavy tank', 'light tank', 'tank destroyer']:
-                            categorized_type = 'ground'
-                        elif vtype in ['spaa', 'anti-aircraft']:
-                            categorized_type = 'spaa'
-                        elif vtype in ['aircraft', 'air', 'fighter', 'bomber', 'attacker']:
-                            categorized_type = 'air'
-                        elif vtype in ['helicopter', 'heli']:
-                            categorized_type = 'heli'
-                        else:
-                            categorized_type = 'ground'  # default
-                        
-                        current_categorized_type = None
-                        if current_vehicle_type in ['tank', 'ground', 'medium tank', 'heavy tank', 'light tank', 'tank destroyer']:
-                            current_categorized_type = 'ground'
-                        elif current_vehicle_type in ['spaa', 'anti-aircraft']:
-                            current_categorized_type = 'spaa'
-                        elif current_vehicle_type in ['aircraft', 'air', 'fighter', 'bomber', 'attacker']:
-                            current_categorized_type = 'air'
-                        elif current_vehicle_type in ['helicopter', 'heli']:
-                            current_categorized_type = 'heli'
-                        else:
-                            current_categorized_type = 'ground'  # default
-                        
-                        if categorized_type == current_categorized_type:
-                            current_menu_vehicle_ids.add(v['vehicle_id'])
-
-            # Only get existing vehicles that are of the same type as the current menu
-            existing = await conn.fetch("""
-                SELECT dg.vehicle_id FROM discord_data_gathered dg
-                JOIN vehicle_table vt ON dg.vehicle_id = vt.vehicle_id
-                WHERE dg.user_id = $1 AND TRIM(TRAILING '.0' FROM vt.vehicle_br::TEXT) = $2
-                AND dg.vehicle_id = ANY($3::int[])
-            """, self.user_id, br, list(current_menu_vehicle_ids))
-
-            existing_ids = {row['vehicle_id'] for row in existing}
-            print(f"Debug: Existing vehicle IDs for current type: {existing_ids}")
-            print(f"Debug: Current menu vehicle IDs: {current_menu_vehicle_ids}")
-
-            # Add new selections
-            for vid in selected_ids - existing_ids:
-                await store_user_vehicle(self.user_id, vid, self.warthunder_user)
-
-            # Remove unselected vehicles (only from the current type being shown)
-            for vid in existing_ids - selected_ids:
-                await conn.execute("""
-                    DELETE FROM discord_data_gathered WHERE user_id = $1 AND vehicle_id = $2
-                """, self.user_id, vid)
-                print(f"Debug: Removed vehicle {vid} for user {self.user_id}")
-
-        if self.next_callback:
-            await self.next_callback()
+        await interaction.edit_original_response(
+            content=f"✅ Saved **{len(view.selected_ids)}** {view.menu.category.upper()} vehicles for BR {view.br}.",
+            view=None
+        )
+        if view.next_callback:
+            await view.next_callback()
         else:
-            # Only post user vehicles if this is the final callback and user is in voice channel
-            member = None
-            try:
-                # Try to get the member object from the interaction
-                if hasattr(self, 'member_ref'):
-                    member = self.member_ref
-                else:
-                    # Fallback: try to find member by user_id
-                    for guild in bot.guilds:
-                        for m in guild.members:
-                            if f"{m.name}#{m.discriminator}" == self.user_id:
-                                member = m
-                                break
-                        if member:
-                            break
-                
-                if member and member.voice and member.voice.channel and member.voice.channel.id in MONITORED_VOICE_CHANNELS:
-                    # Get current BR
-                    br_row = None
-                    if db_pool:
-                        async with db_pool.acquire() as conn:
-                            br_row = await conn.fetchrow("""
-                                SELECT sqb_br FROM sqb_schedule
-                                WHERE NOW() BETWEEN sqb_date AND end_date
-                                LIMIT 1
-                            """)
-                    
-                    if br_row:
-                        br = str(br_row['sqb_br']).rstrip('.0')
-                        await post_user_vehicles_and_cleanup(member, self.user_id, self.warthunder_user, br)
-                    else:
-                        await interaction.followup.send("✅ Vehicle selection saved.", ephemeral=True)
-                else:
-                    await interaction.followup.send("✅ Vehicle selection saved.", ephemeral=True)
-            except Exception as e:
-                print(f"Debug: Error in final callback: {e}")
-                await interaction.followup.send("✅ Vehicle selection saved.", ephemeral=True)
+            await interaction.followup.send("✅ Vehicle selection saved.", ephemeral=True)
 
-class VehicleSelectionView(discord.ui.View):
-    def __init__(self, vehicle_rows, user_id, warthunder_user, is_air=True, next_callback=None, selected_ids=None):
-        super().__init__(timeout=120)
-        self.add_item(VehicleSelect(vehicle_rows, user_id, warthunder_user, is_air, next_callback, selected_ids))
-        
-        # Add a Next button if there's a next callback
-        if next_callback:
-            self.add_item(NextButton(next_callback))
+class EmbedPagesView(discord.ui.View):
+    """Previous/next buttons over a fixed list of embeds"""
 
-class NextButton(discord.ui.Button):
-    def __init__(self, next_callback):
-        super().__init__(style=discord.ButtonStyle.primary, label="Next →", emoji="➡️")
-        self.next_callback = next_callback
+    def __init__(self, pages):
+        super().__init__(timeout=300)
+        self.pages = pages
+        self.index = 0
+        self.update_buttons()
 
-    async def callback(self, interaction: discord.Interaction):
-        await interaction.response.defer(thinking=False, ephemeral=True)
-        
-        # Just proceed to the next selection without making any changes to the current selection
-        if self.next_callback:
-            await self.next_callback()
-        else:
-            await interaction.followup.send("✅ Vehicle selection complete.", ephemeral=True)
+    def update_buttons(self):
+        self.previous_page.disabled = self.index == 0
+        self.next_page.disabled = self.index == len(self.pages) - 1
+
+    async def show(self, interaction):
+        self.update_buttons()
+        await interaction.edit_original_response(embed=self.pages[self.index], view=self)
+
+    @discord.ui.button(label="Previous", emoji="⬅️", style=discord.ButtonStyle.secondary)
+    @deadline_guarded()
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.index = max(self.index - 1, 0)
+        await self.show(interaction)
+
+    @discord.ui.button(label="Next", emoji="➡️", style=discord.ButtonStyle.secondary)
+    @deadline_guarded()
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.index = min(self.index + 1, len(self.pages) - 1)
+        await self.show(interaction)
 
 # ──────────────── RUN ────────────────
 
-bot.run(token)
+if __name__ == "__main__":
+    bot.run(token)
 
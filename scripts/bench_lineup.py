@@ -0,0 +1,56 @@
+"""Benchmark /sqb_lineup solve time against the number of candidates in voice.
+
+Generates random bitset-encoded loadouts at a single BR and times
+solve_lineup() from the bot for growing member counts. The interaction
+deadline is 3 seconds; the solver should stay in the low milliseconds.
+
+    python scripts/bench_lineup.py [--vehicles 300] [--owned 30] [--runs 50]
+"""
+import argparse
+import random
+import statistics
+import time
+
+from bot_module import load_bot_module
+
+MEMBER_COUNTS = [8, 16, 40, 80, 160, 320]
+CATEGORY_WEIGHTS = {'ground': 0.55, 'air': 0.25, 'spaa': 0.1, 'heli': 0.1}
+SLOT_COUNTS = {'ground': 4, 'air': 2, 'spaa': 1, 'heli': 1}
+
+def random_candidates(members, vehicle_count, owned_per_member, rng):
+    category_masks = dict.fromkeys(CATEGORY_WEIGHTS, 0)
+    categories = rng.choices(list(CATEGORY_WEIGHTS), weights=list(CATEGORY_WEIGHTS.values()), k=vehicle_count)
+    for bit, category in enumerate(categories):
+        category_masks[category] |= 1 << bit
+    preferred_mask = sum(1 << bit for bit in rng.sample(range(vehicle_count), vehicle_count // 10))
+    ownership = [
+        sum(1 << bit for bit in rng.sample(range(vehicle_count), owned_per_member))
+        for _ in range(members)
+    ]
+    return ownership, category_masks, preferred_mask
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vehicles", type=int, default=300, help="Vehicles in the catalog at the BR")
+    parser.add_argument("--owned", type=int, default=30, help="Vehicles each member owns at the BR")
+    parser.add_argument("--runs", type=int, default=50, help="Timed runs per member count")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    bot = load_bot_module()
+    rng = random.Random(args.seed)
+
+    print(f"{'members':>8} {'median ms':>10} {'p95 ms':>8} {'max ms':>8}")
+    for members in MEMBER_COUNTS:
+        timings = []
+        for _ in range(args.runs):
+            ownership, category_masks, preferred_mask = random_candidates(members, args.vehicles, args.owned, rng)
+            started = time.perf_counter()
+            bot.solve_lineup(ownership, category_masks, preferred_mask, SLOT_COUNTS)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f"{members:>8} {statistics.median(timings):>10.2f} {p95:>8.2f} {timings[-1]:>8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Compare member cache footprint and startup cost with and without LEAN_MEMORY.
+
+Builds a synthetic guild the size of the home guild (1000 members, squadron
+roles, a full SQB voice channel) and loads it into the bot's own client state
+the way the gateway would: in the default mode every member ends up cached
+after chunking, in lean mode only the members in voice are. Each mode runs in
+a fresh interpreter so RSS numbers don't bleed into each other.
+
+    python scripts/bench_member_cache.py [--members 1000] [--in-voice 40]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from bot_module import load_bot_module
+
+GUILD_ID = 779462911713607690
+VOICE_CHANNEL_ID = 1000
+ROLE_COUNT = 60
+
+def rss_kib():
+    """Current resident set size in KiB (Linux), falling back to the peak RSS elsewhere"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def member_payload(i):
+    return {
+        "user": {"id": str(10_000 + i), "username": f"member{i}", "discriminator": "0", "global_name": None, "avatar": None},
+        "nick": f"Player{i} | Squadron {i % 4}",
+        "roles": [str(100 + (i + k) % ROLE_COUNT) for k in range(3)],
+        "joined_at": "2021-01-01T00:00:00+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+def guild_payload(member_count, in_voice):
+    members = [member_payload(i) for i in range(member_count)]
+    voice_states = [
+        {"user_id": str(10_000 + i), "channel_id": str(VOICE_CHANNEL_ID), "session_id": f"s{i}", "deaf": False,
+         "mute": False, "self_deaf": False, "self_mute": False, "self_video": False, "suppress": False,
+         "request_to_speak_timestamp": None}
+        for i in range(in_voice)
+    ]
+    return {
+        "id": str(GUILD_ID),
+        "name": "Benchmark Guild",
+        "owner_id": "10000",
+        "member_count": member_count,
+        "large": member_count > 250,
+        "features": [],
+        "emojis": [],
+        "stickers": [],
+        "roles": [
+            {"id": str(100 + r), "name": f"Role {r}", "permissions": "0", "position": r, "color": 0,
+             "hoist": False, "managed": False, "mentionable": False}
+            for r in range(ROLE_COUNT)
+        ],
+        "channels": [{"id": str(VOICE_CHANNEL_ID), "type": 2, "name": "SQB", "position": 0, "bitrate": 64000, "user_limit": 0}],
+        "voice_states": voice_states,
+        "members": members,
+    }
+
+def measure(member_count, in_voice):
+    """Load the synthetic guild into the bot's client state and report the cost (runs in a child process)"""
+    bot = load_bot_module()
+    discord = bot.discord
+    payload = guild_payload(member_count, in_voice)
+    chunked_members = payload["members"]
+    # A large guild's GUILD_CREATE only carries members in voice; the rest arrive by chunking
+    payload["members"] = [m for m in chunked_members if int(m["user"]["id"]) - 10_000 < in_voice]
+
+    state = bot.bot._connection
+    rss_before = rss_kib()
+    tracemalloc.start()
+    started = time.perf_counter()
+    guild = state._add_guild_from_data(payload)
+    if state._chunk_guilds:
+        for data in chunked_members:
+            guild._add_member(discord.Member(data=data, guild=guild, state=state))
+    elapsed = time.perf_counter() - started
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "lean": bot.LEAN_MEMORY,
+        "cached_members": len(guild.members),
+        "voice_members": len(guild.get_channel(VOICE_CHANNEL_ID).members),
+        "load_ms": elapsed * 1000,
+        "traced_kib": traced / 1024,
+        "rss_kib": rss_kib() - rss_before,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=1000, help="Members in the guild")
+    parser.add_argument("--in-voice", type=int, default=40, help="Members sitting in the SQB voice channel")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.members, args.in_voice)))
+        return
+
+    results = []
+    for lean in ("false", "true"):
+        env = dict(os.environ, LEAN_MEMORY=lean)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--members", str(args.members), "--in-voice", str(args.in_voice)],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'mode':<8} {'cached':>7} {'in voice':>9} {'load ms':>8} {'traced KiB':>11} {'RSS KiB':>8}")
+    for result in results:
+        mode = "lean" if result["lean"] else "default"
+        print(f"{mode:<8} {result['cached_members']:>7} {result['voice_members']:>9} {result['load_ms']:>8.1f} "
+              f"{result['traced_kib']:>11.0f} {result['rss_kib']:>8}")
+    print("\nLoad time excludes the gateway round trips chunking adds before on_ready in the default mode.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""Load "Warthunder Bot.py" as a module so scripts can reuse its SQL and helpers.
+
+The bot only connects to Discord when run as __main__, so importing it here
+just defines its functions and constants.
+"""
+import importlib.util
+import os
+import sys
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Warthunder Bot.py")
+
+def load_bot_module():
+    if "warthunder_bot" in sys.modules:
+        return sys.modules["warthunder_bot"]
+    spec = importlib.util.spec_from_file_location("warthunder_bot", BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["warthunder_bot"] = module
+    spec.loader.exec_module(module)
+    return module
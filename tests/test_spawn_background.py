@@ -0,0 +1,40 @@
+"""Tests for spawn_background.
+
+Loads "Warthunder Bot.py" through scripts/bot_module, so the guild and
+channel IDs at the top of the bot file have to be filled in.
+
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+
+from bot_module import load_bot_module
+
+bot = load_bot_module()
+
+class SpawnBackgroundTest(unittest.TestCase):
+    def test_job_does_not_inherit_callers_connection(self):
+        seen = {}
+
+        async def job():
+            seen['connection'] = bot.current_connection.get()
+            seen['budget'] = bot.current_budget.get()
+            seen['priority'] = bot.current_priority.get()
+
+        async def caller():
+            bot.current_connection.set(object())
+            bot.current_budget.set(object())
+            async with bot.work_priority('interactive'):
+                await bot.spawn_background(job)
+            # The caller's own context is untouched
+            self.assertIsNotNone(bot.current_connection.get())
+
+        asyncio.run(caller())
+        self.assertEqual(seen, {'connection': None, 'budget': None, 'priority': 'background'})
+
+if __name__ == "__main__":
+    unittest.main()
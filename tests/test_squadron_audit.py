@@ -0,0 +1,79 @@
+"""Tests for the /squadron_audit row builder.
+
+Loads "Warthunder Bot.py" through scripts/bot_module, so the guild and
+channel IDs at the top of the bot file have to be filled in.
+
+    python -m unittest discover tests
+"""
+import collections
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+
+from bot_module import load_bot_module
+
+bot = load_bot_module()
+
+Member = collections.namedtuple("Member", "id nick name display_name bot")
+
+def member(member_id, nick):
+    return Member(member_id, nick, nick.lower(), nick, False)
+
+class BuildAuditRowsTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_index = bot.player_name_index
+        bot.player_name_index = bot.PlayerNameIndex()
+        bot.player_name_index.build([
+            {'squadron_name': "Alpha", 'player_name': "Active", 'points': 1500, 'activity': 40},
+            {'squadron_name': "Alpha", 'player_name': "Idle", 'points': 900, 'activity': 0},
+        ])
+
+        self.saved_map = dict(bot.member_player_map)
+        bot.member_player_map.clear()
+
+    def tearDown(self):
+        bot.player_name_index = self.saved_index
+        bot.member_player_map.clear()
+        bot.member_player_map.update(self.saved_map)
+
+    def issues_by_name(self, holders, loadout_counts):
+        return {row['warthunder_name']: row['issues'] for row in bot.build_audit_rows(holders, loadout_counts)}
+
+    def test_scraped_squadron_flags(self):
+        holders = {member(1, "Active"): "Alpha", member(2, "Idle"): "Alpha", member(3, "Gone"): "Alpha"}
+        issues = self.issues_by_name(holders, {1: 12, 2: 5})
+        self.assertEqual(issues["Active"], set())
+        self.assertEqual(issues["Idle"], {'inactive'})
+        self.assertEqual(issues["Gone"], {'missing', 'no_loadout'})
+
+    def test_squadron_without_rows_is_unscraped(self):
+        holders = {member(4, "Newcomer | Bravo"): "Bravo", member(5, "Loaded"): "Bravo"}
+        rows = bot.build_audit_rows(holders, {5: 7})
+        issues = {row['warthunder_name']: row['issues'] for row in rows}
+        self.assertEqual(issues["Newcomer"], {'unscraped', 'no_loadout'})
+        self.assertEqual(issues["Loaded"], {'unscraped'})
+        self.assertTrue(all(row['points'] is None and row['activity'] is None for row in rows))
+
+    def test_remembered_mappings(self):
+        bot.member_player_map[6] = ("Alpha", bot.normalize_player_name("Idle"), 'fuzzy')
+        bot.member_player_map[7] = ("Alpha", bot.normalize_player_name("Active"), 'exact')
+        holders = {member(6, "Idel"): "Alpha", member(7, "Renamed"): "Alpha"}
+        rows = {row['warthunder_name']: row for row in bot.build_audit_rows(holders, {6: 3, 7: 3})}
+        # A near-match guessed once isn't proof the member is on the squadron page
+        self.assertEqual(rows["Idel"]['issues'], {'missing'})
+        self.assertIsNone(rows["Idel"]['points'])
+        # A mapping from a confirmed match still follows the member after a rename
+        self.assertEqual(rows["Renamed"]['issues'], set())
+        self.assertEqual(rows["Renamed"]['points'], 1500)
+
+    def test_csv_quotes_formula_names(self):
+        holders = {member(8, "=HYPERLINK(\"x\") | Alpha"): "Alpha", member(9, "Active"): "Alpha"}
+        lines = bot.build_audit_csv(bot.build_audit_rows(holders, {}), 5.7).splitlines()
+        self.assertIn("'=HYPERLINK", lines[1])
+        self.assertNotIn(",=", "\n".join(lines))
+        self.assertTrue(lines[2].startswith("9,Active,Active,Alpha,1500,40,0,"))
+
+if __name__ == "__main__":
+    unittest.main()